@@ -0,0 +1,83 @@
+"""compares the incremental feed parser of the podcast cache with the old
+minidom version on large synthetic podcast feeds. Every parser runs in its
+own process, so the peak memory (max rss) of the processes can be compared.
+
+usage: python benchmark_feed_parser.py [number of items ...]
+"""
+import subprocess
+import resource
+import tempfile
+import time
+import sys
+import os
+
+from xml.dom import minidom
+
+os.environ.setdefault('smart_alarm_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smart_alarm'))
+from modules.podcast_cache import newest_episode_url
+
+
+ITEM = """    <item>
+      <title>Nachrichten {number}</title>
+      <description>{description}</description>
+      <guid isPermaLink="false">episode-{number}</guid>
+      <pubDate>Tue, 27 Sep 2016 10:30:00 +0200</pubDate>
+      <enclosure url="{url}" length="1234567" type="audio/mpeg"/>
+      <itunes:duration>5:03</itunes:duration>
+    </item>
+"""
+
+
+def write_feed(feed_file, items, enclosure_from=0):
+    """writes a feed with the given number of items, the first enclosure
+    is in item number enclosure_from"""
+    with open(feed_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">\n'
+                '  <channel>\n    <title>synthetic feed</title>\n')
+        for number in range(items):
+            url = 'http://example.com/episode_{}.mp3'.format(number) if number >= enclosure_from else ''
+            f.write(ITEM.format(number=number, url=url, description='news ' * 100))
+        f.write('  </channel>\n</rss>\n')
+
+
+def minidom_episode_url(feed_file):
+    """the former find_most_recent_news_url_in_xml_file"""
+    itemlist = minidom.parse(feed_file).getElementsByTagName('enclosure')
+    for item in itemlist:
+        if item.attributes['url'].value:
+            return item.attributes['url'].value
+
+
+def run_parser(parser, feed_file, repeat):
+    """runs in a child process, prints duration and peak memory"""
+    function = {'minidom': minidom_episode_url, 'iterparse': newest_episode_url}[parser]
+    start = time.time()
+    for _ in range(repeat):
+        url = function(feed_file)
+    duration = (time.time() - start) / repeat
+    print('{} {} {}'.format(duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, url))
+
+
+def benchmark(items, enclosure_from, repeat=3):
+    feed_file = os.path.join(tempfile.gettempdir(), 'benchmark_feed.xml')
+    write_feed(feed_file, items, enclosure_from)
+    size = os.path.getsize(feed_file)
+    for parser in ('minidom', 'iterparse'):
+        output = subprocess.check_output([sys.executable, __file__, '--run', parser, feed_file, str(repeat)])
+        duration, max_rss, url = output.split()
+        print('{:>6} items {:>6.1f} MB  first enclosure in item {:>5}  {:<9} {:>8.1f} ms  max rss {:>7.1f} MB'.format(
+            items, size / 1e6, enclosure_from, parser, float(duration) * 1000, int(max_rss) / 1024.0))
+    os.remove(feed_file)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run_parser(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        for items in [int(argument) for argument in sys.argv[1:]] or [100, 1000, 5000]:
+            # usual case: the newest item has an enclosure
+            benchmark(items, 0)
+            # worst case: only the last item has one
+            benchmark(items, items - 1)
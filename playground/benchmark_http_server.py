@@ -0,0 +1,111 @@
+"""benchmarks the web interface served by the single threaded wsgiref
+server against the standalone thread pool server: requests per second and
+latency of clients fetching a page, while another client uploads a file
+slowly. Every server runs in its own process.
+
+usage: smart_alarm_path=... python benchmark_http_server.py [clients] [seconds] [path]
+"""
+import subprocess
+import threading
+import httplib
+import socket
+import time
+import sys
+import os
+
+SMART_ALARM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smart_alarm')
+
+
+def serve(kind, port):
+    """runs in the server process"""
+    sys.path.insert(0, SMART_ALARM)
+    os.chdir(os.environ['smart_alarm_path'])
+    import python_server
+    if kind == 'wsgiref':
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        # no access log on stderr, like the thread pool server
+        WSGIRequestHandler.log_message = lambda *args: None
+        httpd = make_server('127.0.0.1', port, python_server.application)
+        while True:
+            httpd.handle_request()
+    else:
+        python_server.serve(port, threads=8)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_until_listening(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def client(port, path, deadline, latencies):
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.time() < deadline:
+        start = time.time()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.time() - start)
+        if response.getheader('connection', '').lower() == 'close' or response.version == 10:
+            connection.close()
+
+
+def slow_upload(port, seconds, size=64 * 1024):
+    """sends a file in small pieces over the given time"""
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.putrequest('PUT', '/upload?name=benchmark.mp3&offset=0')
+    connection.putheader('Content-Length', str(size))
+    connection.endheaders()
+    pieces = 20
+    for _ in range(pieces):
+        connection.send(b'x' * (size // pieces))
+        time.sleep(seconds / float(pieces))
+    connection.send(b'x' * (size - size // pieces * pieces))
+    connection.getresponse().read()
+
+
+def run(kind, clients, seconds, path):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, __file__, '--serve', kind, str(port)])
+    try:
+        wait_until_listening(port)
+        latencies = []
+        deadline = time.time() + seconds
+        uploader = threading.Thread(target=slow_upload, args=(port, seconds / 2.0))
+        uploader.daemon = True
+        uploader.start()
+        threads = [threading.Thread(target=client, args=(port, path, deadline, latencies)) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        print('{:<8} {:>7.0f} requests/s, latency p50 {:>6.1f} ms, p99 {:>7.1f} ms, max {:>7.1f} ms'.format(
+            kind, len(latencies) / float(seconds), latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[3]))
+    else:
+        clients = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+        path = sys.argv[3] if len(sys.argv) > 3 else '/data.xml'
+        for kind in ('wsgiref', 'threads'):
+            run(kind, clients, seconds, path)
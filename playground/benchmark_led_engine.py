@@ -0,0 +1,45 @@
+"""benchmarks the led engine without led strip: time to compute the
+sequences, and frame rate and cpu use while the writer plays them into a
+fake spi sink, which takes as long as the real 8 MHz bus.
+
+usage: python benchmark_led_engine.py [seconds per sequence]
+"""
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smart_alarm'))
+from modules import led_engine
+
+
+NUMBER_OF_LEDS = 9
+
+
+def compute(name, function, *args):
+    start = time.time()
+    sequence = function(NUMBER_OF_LEDS, *args)
+    print('{:<10} {:>6} frames computed in {:>7.1f} ms'.format(name, len(sequence), (time.time() - start) * 1000))
+    return sequence
+
+
+def play(writer, sink, sequence, seconds):
+    frames = sink.frames
+    cpu = sum(os.times()[:2])
+    start = time.time()
+    writer.play(sequence, duration=seconds).wait()
+    duration = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+    print('{:<10} {:>6.1f} fps (target {}), {} dropped, cpu {:>5.1f}%'.format(
+        sequence.name, (sink.frames - frames - 1) / duration, sequence.fps, writer.dropped_frames,
+        cpu / duration * 100))
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    sequences = [compute('rainbow', led_engine.rainbow, 31),
+                 compute('sunrise', led_engine.sunrise, 300),
+                 compute('blinking', led_engine.blinking)]
+    sink = led_engine.FakeSpiSink(speed_hz=8000000)
+    writer = led_engine.LEDWriter(sink, NUMBER_OF_LEDS)
+    for sequence in sequences:
+        play(writer, sink, sequence, seconds)
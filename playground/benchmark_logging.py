@@ -0,0 +1,66 @@
+"""benchmarks the cost of a log call on the caller thread: writing to a
+rotating log file directly compared to the asynchronous log pipeline, and
+counts the write and flush calls which reach the file. The null handler
+shows the cost of the logging module itself. The pipeline processes the
+records after the loop, so only the caller side is measured.
+
+usage: python benchmark_logging.py [number of records]
+"""
+import logging.handlers
+import logging
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'smart_alarm'))
+from modules.log_pipeline import LogPipeline, BatchFileHandler
+
+
+class CountingFile(object):
+    """file wrapper counting the write and flush calls"""
+
+    def __init__(self, f):
+        self.f = f
+        self.writes = self.flushes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.f.write(data)
+
+    def flush(self):
+        self.flushes += 1
+        self.f.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def run(name, handler, count, pipeline=None):
+    stream = handler.stream = CountingFile(getattr(handler, 'stream', None))
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(pipeline or handler)
+    start = time.time()
+    for i in range(count):
+        logger.info('display tick {}'.format(i % 50))
+    duration = time.time() - start
+    if pipeline is not None:
+        pipeline.stop()
+    print('{:<10} {:>6.2f} us per call, {} writes, {} flushes'.format(
+        name, duration / count * 1e6, stream.writes, stream.flushes))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        run('null', logging.NullHandler(), count)
+        run('direct', logging.handlers.RotatingFileHandler(directory + '/direct.log', maxBytes=10 ** 9), count)
+        handler = BatchFileHandler(directory + '/pipeline.log', maxBytes=10 ** 9)
+        run('pipeline', handler, count, LogPipeline([handler], flush_interval=60, batch_size=count + 1,
+                                                     max_queue=count + 1, max_per_minute=count).start())
+    finally:
+        shutil.rmtree(directory)
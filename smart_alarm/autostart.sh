@@ -10,11 +10,22 @@ sudo service mpd stop
 # is pwm1 and enables rpi-zero audio
 gpio_alt -p 18 -f 5
 
+# directory on the tmpfs /run for files which change often, like the
+# metrics of the daemon, to spare the sd card
+sudo mkdir -p /run/smart_alarm
+
 # run smart_alarm main script
 python $smart_alarm_path/start_smala.py &
 
-# change rights of data.xml to make it editable
-sudo chmod o+w $smart_alarm_path/data.xml
+# web interface without apache: run the standalone server next to the daemon
+#python $smart_alarm_path/python_server.py --port 80 &
+
+# make the settings editable by the web server (www-data). data.xml is
+# replaced atomically on every change, so its directory has to be writable.
+# Only the data directory is shared, new files in it get its group
+sudo chgrp -R www-data $smart_alarm_path/data
+sudo chmod -R g+w $smart_alarm_path/data
+sudo chmod g+s $smart_alarm_path/data
 
 # run mopidy for audio control
 #mopidy &
@@ -1,10 +1,15 @@
+import logging
 import os
 
 project_path = os.environ['smart_alarm_path']
 
 # logging configuration
 log_file = str(project_path) + "/logfiles/smala.log"
+# the recent records of all levels are written here when an error is logged
+crash_log_file = str(project_path) + "/logfiles/crash.log"
 logging_level = 'DEBUG'
+# debug records only go to the console and the crash log, not to the sd card
+file_logging_level = 'INFO'
 
 format_log_file = "%(asctime)s :: %(levelname)s :: " \
                   "%(funcName)s in %(filename)s (l:%(lineno)d) :: %(message)s"
@@ -51,8 +56,8 @@ logging_dict = {
             'stream': 'ext://sys.stdout'
         },
         'file': {
-            'level': logging_level,
-            'class': 'logging.handlers.RotatingFileHandler',
+            'level': file_logging_level,
+            'class': 'modules.log_pipeline.BatchFileHandler',
             'formatter': 'format_for_file',
             'filename': log_file,
             'maxBytes': 500000,
@@ -60,3 +65,14 @@ logging_dict = {
         }
     },
 }
+
+# the file handler is run by a background thread of the log pipeline, see
+# modules/log_pipeline.py. The console gets the records right away
+pipeline_options = {
+    'flush_interval': 5.0,
+    'batch_size': 200,
+    'max_per_minute': 30,
+    'ring_size': 1000,
+    'dump_file': crash_log_file,
+    'dump_formatter': logging.Formatter(format_log_file, '%Y-%m-%d %H:%M:%S'),
+}
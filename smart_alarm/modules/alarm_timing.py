@@ -0,0 +1,132 @@
+import threading
+import json
+import math
+import time
+import os
+import logging
+
+from modules.clock import monotonic
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+# phases of an alarm in the order they usually happen. 'first audio' is the
+# first sample of anything (usually the wake-up message), 'content start'
+# the first sample of the podcast, music or radio, which completes the record
+PHASES = ['detected', 'thread started', 'amp on', 'tts start', 'first audio', 'tts end', 'content ready',
+          'content start']
+LAST_PHASE = 'content start'
+
+
+class AlarmTiming(object):
+    """
+    timing record of one alarm. Every phase is stored as seconds after the
+    scheduled alarm time. The offsets come from the monotonic clock, which
+    is tied to the wall clock once when the record is created, so a clock
+    change during the alarm doesn't distort them. Only the first time of
+    every phase counts.
+    """
+
+    def __init__(self, scheduled, content=None, on_complete=None):
+        self.scheduled = scheduled
+        self.content = content
+        self.on_complete = on_complete
+        self.origin = monotonic() - (time.time() - scheduled)
+        self.phases = {}
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        with self.lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = monotonic() - self.origin
+            complete = phase == LAST_PHASE
+        logger.debug('alarm phase {!r} after {:.3f} sec'.format(phase, self.phases[phase]))
+        if complete and self.on_complete is not None:
+            self.on_complete(self)
+
+    def finish(self):
+        """returns True the first time only, so the record is saved once"""
+        with self.lock:
+            finished, self.finished = self.finished, True
+            return not finished
+
+    def to_dict(self):
+        with self.lock:
+            return {'scheduled': self.scheduled, 'content': self.content, 'phases': dict(self.phases)}
+
+
+class TimingHistory(object):
+    """
+    rolling history of the alarm timing records in a file of json lines.
+    Keeps at least the newest max_records, the file is compacted when it
+    holds twice as many.
+    """
+
+    def __init__(self, history_file=project_path + '/alarm_timing.log', max_records=100):
+        self.history_file = history_file
+        self.max_records = max_records
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            records = self.read()
+            if len(records) >= 2 * self.max_records:
+                self.write(records[-self.max_records:] + [record.to_dict()])
+            else:
+                with open(self.history_file, 'a') as f:
+                    f.write(json.dumps(record.to_dict()) + '\n')
+
+    def records(self):
+        with self.lock:
+            return self.read()[-self.max_records:]
+
+    def summary(self):
+        """returns {phase: (number of alarms, median, 90th percentile,
+        99th percentile, maximum)} of the seconds after the scheduled time"""
+        offsets = {}
+        for record in self.records():
+            for phase, offset in record['phases'].items():
+                offsets.setdefault(phase, []).append(offset)
+        summary = {}
+        for phase, values in offsets.items():
+            values.sort()
+            summary[phase] = (len(values), percentile(values, 50), percentile(values, 90),
+                              percentile(values, 99), values[-1])
+        return summary
+
+    def log_summary(self):
+        summary = self.summary()
+        for phase in sorted(summary, key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES)):
+            logger.info('{:<15} {:>4} alarms, p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f} sec'.format(
+                phase, *summary[phase]))
+
+    def read(self):
+        records = []
+        try:
+            with open(self.history_file) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # skip lines which were cut off by a crash
+                        continue
+        except IOError:
+            pass
+        return records
+
+    def write(self, records):
+        temp_file = self.history_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.rename(temp_file, self.history_file)
+
+
+def percentile(values, percent):
+    """nearest rank percentile of the sorted values"""
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
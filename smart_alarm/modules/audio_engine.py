@@ -0,0 +1,461 @@
+import threading
+import time
+import os
+import logging
+
+from collections import deque
+
+from modules.cancellation import CancelToken, run_callback
+from modules.clock import monotonic
+from modules.metrics import registry
+from modules.wakeup import Wakeup
+
+
+logger = logging.getLogger(__name__)
+
+
+class AudioItem(object):
+    """
+    one entry of the audio queue. Either a file played by the sink, or a
+    function playing by itself (stream, online radio, live speech), which
+    is called with a CancelToken and has to return soon after it was
+    cancelled. ramp is an optional (start volume, end volume, seconds)
+    tuple, volumes 0.0 - 1.0. backend names the kind of playback in the
+    stop latency metrics. on_start is called when the first sample is
+    played, on_finish when the item was played or dropped. Functions have
+    to call start() themselves once they play.
+    """
+
+    def __init__(self, source=None, function=None, ramp=None, name=None, backend=None, on_start=None,
+                 on_finish=None):
+        self.source = source
+        self.function = function
+        self.ramp = ramp
+        self.name = name or source or getattr(function, '__name__', 'function')
+        self.backend = backend or ('mp3' if function is None else 'function')
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.started_at = None
+        self.stopped = False
+        self.done = threading.Event()
+
+    def start(self):
+        """marks the first sample of the item as played"""
+        if self.started_at is not None:
+            return
+        self.started_at = monotonic()
+        if self.on_start is not None:
+            run_callback(self.on_start)
+
+    def volume(self, elapsed):
+        if self.ramp is None:
+            return 1.0
+        start, end, duration = self.ramp
+        if duration <= 0 or elapsed >= duration:
+            return end
+        return start + (end - start) * elapsed / duration
+
+    def wait(self, timeout=None):
+        """blocks until the item was played or dropped"""
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def __repr__(self):
+        return 'AudioItem({!r})'.format(self.name)
+
+
+class AudioEngine(object):
+    """
+    one long-lived thread owning the audio output and the amplifier. Other
+    threads put items into its queue instead of waiting for each other.
+    Consecutive files are handed to the sink before the current one ends,
+    so they play without gap. The amp is switched on before the first item
+    and only switched off after idle_timeout seconds without playback.
+    The current item is cancelled through a CancelToken, the time from the
+    cancel until the item stopped is recorded per backend. While a file
+    plays, the thread sleeps in sink.wait() until the file ends or wake()
+    is called, it only wakes up every tick during a volume ramp.
+    """
+
+    def __init__(self, sink, amp=None, idle_timeout=30, amp_warmup=0.3, tick=0.02):
+        self.sink = sink
+        # function switching the amplifier on (1) or off (0)
+        self.amp = amp
+        self.idle_timeout = idle_timeout
+        self.amp_warmup = amp_warmup
+        self.tick = tick
+        self.queue = deque()
+        self.current = None
+        # file item already handed to the sink to follow the current one
+        self.pending = None
+        self.amp_on = False
+        # when the amp was switched on, and the last playback ended
+        self.amp_since = self.idle_since = monotonic()
+        self.lock = threading.Lock()
+        # wakes up the idle thread when an item was queued
+        self.wakeup = Wakeup()
+        # cancels the current item (stop and preempt)
+        self.token = CancelToken()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='audio engine')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.running = False
+        self.stop()
+        if self.thread is not None:
+            self.thread.join()
+
+    def enqueue(self, item):
+        """plays item after everything already queued"""
+        with self.lock:
+            self.queue.append(item)
+        self.wake()
+        return item
+
+    def preempt(self, item):
+        """interrupts the current item and plays item right away. The rest
+        of the queue is played afterwards."""
+        with self.lock:
+            if self.pending is not None:
+                self.queue.appendleft(self.pending)
+                self.pending = None
+            self.queue.appendleft(item)
+            token = self.token if self.current is not None else None
+        if token is not None:
+            token.cancel()
+        self.wake()
+        return item
+
+    def stop(self):
+        """stops the current item and drops the queued ones"""
+        with self.lock:
+            dropped = list(self.queue)
+            if self.pending is not None:
+                dropped.append(self.pending)
+                self.pending = None
+            self.queue.clear()
+            token = self.token if self.current is not None else None
+        if token is not None:
+            token.cancel()
+        self.wake()
+        for item in dropped:
+            self.finish(item, stopped=True)
+        if dropped:
+            logger.debug('dropped {} queued audio items'.format(len(dropped)))
+
+    def warm_up(self):
+        """switches the amp on ahead of an item which is still being
+        prepared, so it warms up in the meantime"""
+        with self.lock:
+            self.idle_since = monotonic()
+            if not self.amp_on:
+                self.switch_amp(1)
+        self.wake()
+
+    def wake(self):
+        """makes the thread look at the queue, whether it is idle or
+        playing files"""
+        self.wakeup.notify()
+        self.sink.wake()
+
+    def busy(self):
+        """True while something is playing or queued"""
+        with self.lock:
+            return self.current is not None or bool(self.queue)
+
+    def run(self):
+        while self.running:
+            item = None
+            with self.lock:
+                if self.queue:
+                    item = self.current = self.queue.popleft()
+                    self.token = token = CancelToken()
+                    if not self.amp_on:
+                        self.switch_amp(1)
+                else:
+                    idle = monotonic() - self.idle_since
+                    if self.amp_on and idle >= self.idle_timeout:
+                        self.switch_amp(0)
+                    # without the amp on there is nothing to time
+                    timeout = self.idle_timeout - idle if self.amp_on else None
+            if item is None:
+                self.wakeup.wait(timeout)
+                continue
+
+            warmup = self.amp_since + self.amp_warmup - monotonic()
+            if warmup > 0:
+                time.sleep(warmup)
+            try:
+                if item.function is not None:
+                    self.play_function(item, token)
+                else:
+                    item = self.play_files(item, token)
+            except Exception as e:
+                logger.error('playing {} failed: {}'.format(item, e))
+                self.finish(item, stopped=True)
+            if token.cancelled():
+                self.record_stop(item, token.elapsed())
+            with self.lock:
+                self.current = None
+                self.idle_since = monotonic()
+        self.sink.stop()
+        if self.amp_on:
+            self.switch_amp(0)
+
+    def play_function(self, item, token):
+        logger.debug('playing {}'.format(item))
+        item.function(token)
+        self.finish(item, stopped=token.cancelled())
+
+    def play_files(self, item, token):
+        """plays item and the directly following file items without gap.
+        Returns the last item played."""
+        logger.debug('playing {}'.format(item))
+        self.sink.set_volume(item.volume(0))
+        self.sink.play(item.source)
+        item.start()
+        files_started = self.sink.files_started()
+        # silence the sink right away on cancel, stop() also wakes sink.wait()
+        token.add_callback(self.sink.stop)
+        started = monotonic()
+        ramping = item.ramp is not None
+        next_item = None
+        while not token.cancelled():
+            if next_item is None:
+                next_item = self.next_file_item()
+                if next_item is not None:
+                    self.sink.queue(next_item.source)
+            # busy first: a queued file can't start after the sink ended
+            busy = self.sink.busy()
+            if next_item is not None and self.sink.files_started() > files_started:
+                # the sink started the queued file, maybe it even ended already
+                files_started += 1
+                self.finish(item)
+                item, next_item = next_item, None
+                with self.lock:
+                    self.current = item
+                    self.pending = None
+                started = monotonic()
+                ramping = item.ramp is not None
+                item.start()
+                logger.debug('playing {} without gap'.format(item))
+            if not busy:
+                break
+            if ramping:
+                elapsed = monotonic() - started
+                self.sink.set_volume(item.volume(elapsed))
+                ramping = elapsed < item.ramp[2]
+            # sleeps until the file ends, something was queued or cancelled
+            self.sink.wait(self.tick if ramping else None)
+
+        token.remove_callback(self.sink.stop)
+        self.finish(item, stopped=token.cancelled())
+        with self.lock:
+            if self.pending is not None:
+                # ended before the sink switched to it, play it normally
+                self.queue.appendleft(self.pending)
+                self.pending = None
+        return item
+
+    def next_file_item(self):
+        """takes the next item from the queue if it is a file"""
+        with self.lock:
+            if self.queue and self.queue[0].function is None:
+                self.pending = self.queue.popleft()
+                return self.pending
+        return None
+
+    def record_stop(self, item, latency):
+        logger.info('stopped {} ({}) after {:.1f} ms'.format(item, item.backend, latency * 1000))
+        registry.observe('audio_stop_latency_seconds', latency, backend=item.backend)
+
+    def finish(self, item, stopped=False):
+        item.stopped = stopped
+        item.done.set()
+        if item.on_finish is not None:
+            run_callback(item.on_finish)
+
+    def switch_amp(self, on):
+        self.amp_on = bool(on)
+        if on:
+            self.amp_since = monotonic()
+        if self.amp is not None:
+            self.amp(1 if on else 0)
+
+
+class PygameSink(object):
+    """plays files with pygame.mixer.music, which is initialized once. The
+    mixer posts an event when a file ends or the queued one starts, wait()
+    sleeps in the pygame event queue until then."""
+
+    def __init__(self):
+        import pygame
+        self.music = pygame.mixer.music
+        self.mixer = pygame.mixer
+        self.events = pygame.event
+        self.timer = pygame.time
+        # the event queue needs the video system, which has nothing to show
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        pygame.display.init()
+        self.end_event, self.wake_event, self.timeout_event = (pygame.USEREVENT, pygame.USEREVENT + 1,
+                                                               pygame.USEREVENT + 2)
+        self.events.set_blocked(None)
+        self.events.set_allowed([self.end_event, self.wake_event, self.timeout_event])
+        self.music.set_endevent(self.end_event)
+        self.started = 0
+        self.queued = False
+        self.last_position = -1
+
+    def play(self, path):
+        if not self.mixer.get_init():
+            self.mixer.init()
+        self.music.load(path)
+        self.music.play()
+        self.started += 1
+        self.queued = False
+        self.last_position = -1
+
+    def queue(self, path):
+        self.music.queue(path)
+        # a file queued after the music ended is never played
+        self.queued = self.busy()
+
+    def files_started(self):
+        """number of files started, including queued ones. pygame doesn't
+        tell when the queued file starts: it did once the position went back
+        or the music ended while a file was queued"""
+        position = self.position()
+        if self.queued and (0 <= position < self.last_position or not self.busy()):
+            self.started += 1
+            self.queued = False
+        self.last_position = position
+        return self.started
+
+    def busy(self):
+        return bool(self.mixer.get_init()) and self.music.get_busy()
+
+    def position(self):
+        """milliseconds played of the current file, starts again at 0 when
+        a queued file starts"""
+        return self.music.get_pos() if self.mixer.get_init() else -1
+
+    def set_volume(self, volume):
+        if self.mixer.get_init():
+            self.music.set_volume(volume)
+
+    def wait(self, timeout=None):
+        """sleeps until a file ended or started, wake() was called or the
+        timeout passed"""
+        if timeout is not None:
+            self.timer.set_timer(self.timeout_event, max(1, int(timeout * 1000)))
+        self.events.wait()
+        if timeout is not None:
+            self.timer.set_timer(self.timeout_event, 0)
+        # the caller looks at the state of the sink after every wake up
+        self.events.get()
+
+    def wake(self):
+        self.events.post(self.events.Event(self.wake_event))
+
+    def stop(self):
+        self.queued = False
+        if self.mixer.get_init():
+            self.music.stop()
+        self.wake()
+
+
+class NullSink(object):
+    """
+    sink without audio output, for tests and machines without sound card.
+    Pretends to play every file for durations.get(path, default_duration)
+    seconds, or durations(path) if it is a function, and records what was
+    played and the volumes set.
+    """
+
+    def __init__(self, durations=None, default_duration=0.1):
+        self.durations = durations or {}
+        self.default_duration = default_duration
+        self.played = []
+        self.volumes = []
+        self.current = None
+        self.queued = None
+        self.started = None
+        self.files = 0
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
+
+    def play(self, path):
+        with self.lock:
+            self.queued = None
+            self.start(path)
+
+    def queue(self, path):
+        with self.lock:
+            self.queued = path
+
+    def busy(self):
+        with self.lock:
+            self.update()
+            return self.current is not None
+
+    def files_started(self):
+        with self.lock:
+            self.update()
+            return self.files
+
+    def position(self):
+        with self.lock:
+            self.update()
+            return int((monotonic() - self.started) * 1000) if self.current is not None else -1
+
+    def set_volume(self, volume):
+        self.volumes.append(volume)
+
+    def wait(self, timeout=None):
+        """sleeps until the current file ends, wake() was called or the
+        timeout passed"""
+        with self.lock:
+            files = self.files
+            self.update()
+            if self.current is None or self.files != files:
+                # ended or switched to the queued file since the caller looked
+                return
+            remaining = max(self.started + self.duration(self.current) - monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self.wakeup.wait(timeout)
+
+    def wake(self):
+        self.wakeup.notify()
+
+    def stop(self):
+        with self.lock:
+            self.current = self.queued = None
+        self.wake()
+
+    def start(self, path):
+        self.current, self.started = path, monotonic()
+        self.played.append(path)
+        self.files += 1
+
+    def update(self):
+        if self.current is None:
+            return
+        ended = self.started + self.duration(self.current)
+        if monotonic() >= ended:
+            self.current = None
+            if self.queued is not None:
+                path, self.queued = self.queued, None
+                self.start(path)
+                self.started = ended
+
+    def duration(self, path):
+        if callable(self.durations):
+            return self.durations(path)
+        return self.durations.get(path, self.default_duration)
@@ -0,0 +1,71 @@
+import threading
+import logging
+
+from modules.clock import monotonic
+
+
+logger = logging.getLogger(__name__)
+
+
+class CancelToken(object):
+    """
+    tells a running playback to stop. Backends either block in wait(),
+    which returns as soon as the token is cancelled, or register a callback
+    which interrupts them right away (stop the mixer, kill the decoder).
+    Calling the token returns True once it is cancelled, so it can be used
+    where a stop function is expected.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.cancelled_at = None
+
+    def cancel(self):
+        """cancels the token and runs the registered callbacks"""
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.cancelled_at = monotonic()
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            run_callback(callback)
+
+    def cancelled(self):
+        return self.event.is_set()
+
+    __call__ = cancelled
+
+    def wait(self, timeout=None):
+        """blocks until the token is cancelled or the timeout passed.
+        Returns True if it was cancelled."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def add_callback(self, callback):
+        """calls callback() on cancel, right away if already cancelled"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        run_callback(callback)
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def elapsed(self):
+        """seconds since the token was cancelled, None if it wasn't"""
+        if self.cancelled_at is None:
+            return None
+        return monotonic() - self.cancelled_at
+
+
+def run_callback(callback):
+    try:
+        callback()
+    except Exception as e:
+        logger.warning('cancel callback {} failed: {}'.format(callback, e))
@@ -0,0 +1,33 @@
+import ctypes
+import ctypes.util
+import time
+import os
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+CLOCK_MONOTONIC = 1
+
+
+def _monotonic_clock_gettime():
+    """reads CLOCK_MONOTONIC through libc, since python 2 has no time.monotonic"""
+    value = timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(value)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return value.tv_sec + value.tv_nsec * 1e-9
+
+
+# monotonic() returns seconds of a clock which never jumps back or forth,
+# unlike time.time() when ntp or the user sets the system clock. Use it for
+# measuring durations and deadlines.
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    monotonic = _monotonic_clock_gettime
+
@@ -1,52 +1,282 @@
-from Adafruit_LED_Backpack import AlphaNum4
+import threading
 import time
 import logging
 import os
 
+from array import array
+from collections import deque
+
+from modules import hardware
+from modules.clock import monotonic
+from modules.metrics import registry
+
 
 # read environmental variable for project path
 project_path = os.environ['smart_alarm_path']
 logger = logging.getLogger(__name__)
 
 
+class FrameBuffer(object):
+    """
+    keeps a copy of the buffer last sent to the HT16K33 and sends only the
+    changed bytes. Runs of changed bytes are sent in one I2C transaction
+    (the chip increments the register address by itself), unchanged frames
+    are skipped. Counts frames, transactions and bytes on the bus.
+    """
+
+    # bytes on the bus per transaction besides the data: address and register
+    overhead = 2
+    # unchanged bytes between two changed runs that are sent along, since
+    # that is cheaper than starting a new transaction
+    max_gap = 2
+
+    def __init__(self, device, size=16):
+        self.device = device
+        self.size = size
+        # unknown content of the display, the first frame is sent completely
+        self.sent = None
+        self.lock = threading.Lock()
+        self.frames = self.skipped = self.transactions = self.bytes = 0
+        self.brightness = None
+        self.last_stats = (time.time(), 0, 0, 0, 0)
+
+    def flush(self, buffer):
+        """sends the changes of buffer since the last flush"""
+        with self.lock:
+            self.frames += 1
+            registry.inc('display_frames_total')
+            for start, end in self.changed_runs(buffer):
+                self.send(start, buffer[start:end])
+            self.sent = bytearray(buffer)
+
+    def changed_runs(self, buffer):
+        """returns [(start, end)] of the byte ranges which differ from the
+        buffer sent last"""
+        if self.sent is None:
+            return [(0, self.size)]
+        runs = []
+        for i in range(self.size):
+            if buffer[i] == self.sent[i]:
+                continue
+            if runs and i - runs[-1][1] <= self.max_gap:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1])
+        if not runs:
+            self.skipped += 1
+            registry.inc('display_frames_skipped_total')
+        return runs
+
+    def send(self, register, data):
+        self.device.writeList(register, list(data))
+        self.transactions += 1
+        self.bytes += len(data) + self.overhead
+        registry.inc('display_i2c_transactions_total')
+        registry.inc('display_i2c_bytes_total', len(data) + self.overhead)
+
+    def set_brightness(self, display_lib, value):
+        """sends the brightness command only if the value changed"""
+        with self.lock:
+            if value == self.brightness:
+                return
+            display_lib.set_brightness(value)
+            self.brightness = value
+            self.transactions += 1
+            self.bytes += 1 + 1
+            registry.inc('display_i2c_transactions_total')
+            registry.inc('display_i2c_bytes_total', 1 + 1)
+
+    def invalidate(self):
+        """forgets the state of the display, the next frame is sent completely"""
+        with self.lock:
+            self.sent = None
+
+    def stats(self):
+        """returns frames, skipped frames, transactions and bytes per second
+        since the last call"""
+        with self.lock:
+            now = time.time()
+            last_time, frames, skipped, transactions, sent_bytes = self.last_stats
+            self.last_stats = (now, self.frames, self.skipped, self.transactions, self.bytes)
+        duration = max(now - last_time, 1e-6)
+        return {'frames': (self.frames - frames) / duration,
+                'skipped': (self.skipped - skipped) / duration,
+                'transactions': (self.transactions - transactions) / duration,
+                'bytes': (self.bytes - sent_bytes) / duration}
+
+
+class Animation(object):
+    """
+    precompiled animation: every frame is stored as the 16-bit segment masks
+    of the 4 digits in one flat array, so playing a frame is only copying 4
+    numbers into the display buffer
+    """
+
+    def __init__(self, frames, interval, name='animation'):
+        self.frames = array('H', (mask for frame in frames for mask in frame))
+        self.interval = interval
+        self.name = name
+
+    def __len__(self):
+        return len(self.frames) // 4
+
+    def frame(self, number):
+        return self.frames[4 * number:4 * number + 4]
+
+
+def segment_mask(*segments):
+    """16-bit mask of a digit with the given segments (0 - 15) switched on"""
+    mask = 0
+    for segment in segments:
+        mask |= 1 << segment
+    return mask
+
+
+def compile_all_digits(sequence1, sequence2, interval, name):
+    """the same two segments on all digits in every frame"""
+    frames = []
+    for a in range(len(sequence1)):
+        mask = segment_mask(sequence1[a], sequence2[a])
+        frames.append((mask, mask, mask, mask))
+    return Animation(frames, interval, name)
+
+
+def compile_snake(interval=0.02):
+    """a snake running through the display from left to right"""
+    loop = [3, 2, 1, 0, 5, 4, 3, 14]
+    frames = []
+    for z in range(4):
+        for segment in loop:
+            frame = [0, 0, 0, 0]
+            frame[z] = segment_mask(segment)
+            frames.append(frame)
+    return Animation(frames, interval, 'snake')
+
+
+def compile_text(message, interval=0.12):
+    """scrolls the message from right to left through the display"""
+    digit_values = hardware.digit_values()
+    masks = [digit_values.get(character, 0) for character in "   " + message + "   "]
+    frames = [masks[pos:pos + 4] for pos in range(len(masks) - 3)]
+    return Animation(frames, interval, 'scroll {!r}'.format(message))
+
+
+# goes from top segments to bottom segments
+SHUTDOWN = compile_all_digits([0, 8, 9, 12, 11, 3], [0, 10, 9, 12, 13, 3], 0.1, 'shutdown')
+# big stars circling in each digit
+BIG_STARS = compile_all_digits([6, 8, 9, 10, 7, 13, 12, 11], [7, 13, 12, 11, 6, 8, 9, 10], 0.03, 'big stars')
+SNAKE = compile_snake()
+
+
+class Renderer(object):
+    """
+    render thread playing animations on the display. Callers submit an
+    animation and return at once. Frame n is shown at start + n * interval
+    of the monotonic clock, so time spent rendering does not add up; frames
+    whose time already passed are dropped to stay at the frame rate.
+    """
+
+    def __init__(self, display):
+        self.display = display
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.dropped_frames = 0
+        self.thread = threading.Thread(target=self.run, name='display renderer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, animation, iterations=1):
+        """queues the animation and returns an Event, set when it is done"""
+        done = threading.Event()
+        with self.condition:
+            self.queue.append((animation, iterations, done))
+            self.display.display_in_use = True
+            self.condition.notify()
+        return done
+
+    def stop(self):
+        """ends the current animation and drops the queued ones"""
+        with self.condition:
+            dropped = list(self.queue)
+            self.queue.clear()
+            self.cancelled = True
+        for _, _, done in dropped:
+            done.set()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.display.display_in_use = False
+                    self.condition.wait()
+                animation, iterations, done = self.queue.popleft()
+                self.cancelled = False
+            try:
+                self.render(animation, iterations)
+            except Exception as e:
+                logger.error('playing animation {} failed: {}'.format(animation.name, e))
+            finally:
+                done.set()
+
+    def render(self, animation, iterations):
+        frame_count = len(animation) * iterations
+        start = monotonic()
+        number = 0
+        while number < frame_count and not self.cancelled:
+            self.display.show_frame(animation.frame(number % len(animation)))
+            number += 1
+            deadline = start + number * animation.interval
+            now = monotonic()
+            if now < deadline:
+                time.sleep(deadline - now)
+            elif now > deadline + animation.interval:
+                # too late for the next frames, skip them
+                late = int((now - deadline) / animation.interval)
+                self.dropped_frames += late
+                number += late
+
+
 class Display(object):
     """
     Display class: manages all methods concerning the alphanumeric display.
+    Animations are precompiled and played by a render thread, so showing
+    them doesn't block the caller.
     """
 
-    def __init__(self):
+    def __init__(self, display_lib=None):
         """init function: imports adafruit alphanumeric display class and begins"""
         # write to error.log file
-        self.display_lib = AlphaNum4.AlphaNum4()
+        self.display_lib = display_lib or hardware.alphanum_display()
         self.display_lib.begin()
+        self.framebuffer = FrameBuffer(self.display_lib._device, len(self.display_lib.buffer))
         self.display_in_use = False
+        # compiled scroll animations of recent messages
+        self.texts = {}
+        self.renderer = Renderer(self)
         logger.info('display-module initialized')
 
-    def scroll(self, message, number_of_iteration):
+    def play(self, animation, number_of_iterations, wait=False):
+        done = self.renderer.play(animation, number_of_iterations)
+        if wait:
+            done.wait()
+        return done
+
+    def show_frame(self, masks):
+        """shows one frame of segment masks, used by the render thread"""
+        for pos, mask in enumerate(masks):
+            self.display_lib.set_digit_raw(pos, mask)
+        self.framebuffer.flush(self.display_lib.buffer)
+
+    def scroll(self, message, number_of_iteration, wait=False):
         """scrolls the given message from right to left through the display.
         Set number_f_iterations = 1, in order to display the message just once."""
-        self.display_in_use = True
-        pos = 0
-        counter = 0
-        message = "   " + message + "   "
-        # loop to scroll through the message
-        while counter < (len(message) - 3) * number_of_iteration:
-            # Clear the display buffer.
-            self.display_lib.clear()
-            # Print a 4 character string to the display buffer.
-            self.display_lib.print_str(message[pos:pos + 4])
-            # Write the display buffer to the hardware.  This must be called to
-            # update the actual display LEDs.
-            self.display_lib.write_display()
-            # Increment position. Wrap back to 0 when the end is reached.
-            pos += 1
-            if pos > len(message) - 4:
-                pos = 0
-            # Delay for half a second
-            time.sleep(0.12)
-            # increase counter in order to end the loop at the end of the message
-            counter += 1
-        self.display_in_use = False
+        animation = self.texts.get(message)
+        if animation is None:
+            if len(self.texts) > 32:
+                self.texts.clear()
+            animation = self.texts[message] = compile_text(message)
+        return self.play(animation, number_of_iteration, wait)
 
     def show_time(self, time):
         """displays the given time using adafruit library"""
@@ -56,17 +286,26 @@ class Display(object):
 
     def set_brightness(self, value):
         """change the displays brightness. Value is between 0 and 15"""
-        self.display_lib.set_brightness(value)
+        self.framebuffer.set_brightness(self.display_lib, value)
 
     def clear_class(self):
         """clears the display, in order to accept new content
         (note that it needs to be called different to -pythonic- 'clear')"""
+        if self.display_in_use:
+            return
         self.display_lib.clear()
 
     def write(self):
-        """writes all the earlier given content to the display,
+        """writes the changed content to the display,
         needs to be done at every end of the loop"""
-        self.display_lib.write_display()
+        if self.display_in_use:
+            return
+        self.framebuffer.flush(self.display_lib.buffer)
+
+    def bus_stats(self):
+        """frames, skipped frames, I2C transactions and bytes per second
+        since the last call"""
+        return self.framebuffer.stats()
 
     def set_decimal(self, pos, decimal):
         """activates the decimal point. First argument is the poosition
@@ -82,56 +321,14 @@ class Display(object):
 
     # The following functions are not mandatory, because they just contain little display games
 
-    def shutdown(self, number_of_iterations):
+    def shutdown(self, number_of_iterations, wait=False):
         """goes from top segments to bottom segments"""
-        self.display_in_use = True
-        delay = 0.1
-        sequence1 = [0, 8, 9, 12, 11, 3]
-        sequence2 = [0, 10, 9, 12, 13, 3]
-        counter = 0
-        while counter < number_of_iterations:
-            for a in range(len(sequence1)):
-                self.clear_class()
-                for i in range(4):
-                    self.set_segment(sequence1[a] + (i * 16), 1)
-                    self.set_segment(sequence2[a] + (i * 16), 1)
-                self.write()
-                time.sleep(delay)
-            counter += 1
-        self.display_in_use = False
+        return self.play(SHUTDOWN, number_of_iterations, wait)
 
-    def snake(self, number_of_iterations):
+    def snake(self, number_of_iterations, wait=False):
         """runs a snake through the display from left to right"""
-        self.display_in_use = True
-        counter = 0
-        delay = 0.02
-        loop = [3, 2, 1, 0, 5, 4, 3, 14]
-        while counter < number_of_iterations:
-            for z in range(4):
-                for i in range(len(loop)):
-                    self.clear_class()
-                    self.set_segment(loop[i] + (z * 16), 1)
-                    self.write()
-                    time.sleep(delay)
-            counter += 1
-        self.display_in_use = False
+        return self.play(SNAKE, number_of_iterations, wait)
 
-    def big_stars(self, number_of_iterations):
+    def big_stars(self, number_of_iterations, wait=False):
         """big stars circling in each digit"""
-        self.display_in_use = True
-        delay = 0.03
-        counter = 0
-        segment1 = [6, 8, 9, 10, 7, 13, 12, 11]
-        segment2 = [7, 13, 12, 11, 6, 8, 9, 10]
-        while counter < number_of_iterations:
-            for a in range(len(segment1)):
-                self.clear_class()
-                for i in range(4):
-                    self.set_segment(segment1[a] + (i * 16), 1)
-                    self.set_segment(segment2[a] + (i * 16), 1)
-                self.write()
-                time.sleep(delay)
-            counter += 1
-        self.display_in_use = False
-
-
+        return self.play(BIG_STARS, number_of_iterations, wait)
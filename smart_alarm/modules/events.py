@@ -0,0 +1,114 @@
+import fcntl
+import json
+import threading
+import time
+import os
+import logging
+
+from modules.xml_store import data_path, share
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog(object):
+    """
+    small append-only log of state change events (settings, music library,
+    alarm status), shared by the web server and the alarm daemon through a
+    file of json lines. Every event gets a increasing sequence number, which
+    clients use as cursor to wait for the events they haven't seen yet.
+    Like data.xml, the log and its lock file are kept writable for both.
+    """
+
+    def __init__(self, log_file=data_path + '/events.log', max_events=100, poll_interval=0.2):
+        self.log_file = log_file
+        self.lock_file = log_file + '.lock'
+        self.max_events = max_events
+        self.poll_interval = poll_interval
+        self.events = []
+        self.stamp = None
+        # wakes up waiting threads on events published by this process
+        self.condition = threading.Condition()
+
+    def publish(self, event_type, data=None):
+        """appends an event of the given type to the log and returns it"""
+        with self.condition:
+            with open(self.lock_file, 'a') as lock:
+                share(lock)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                events = self.read()
+                event = {'seq': events[-1]['seq'] + 1 if events else 1,
+                         'time': time.time(),
+                         'type': event_type,
+                         'data': data}
+                if len(events) >= 2 * self.max_events:
+                    # compact the log by rewriting only the newest events
+                    self.write(events[-self.max_events:] + [event])
+                else:
+                    with open(self.log_file, 'a') as f:
+                        share(f)
+                        f.write(json.dumps(event) + '\n')
+                self.read()
+            self.condition.notify_all()
+        logger.debug('published event {}: {}'.format(event_type, data))
+        return event
+
+    def version(self):
+        """returns the sequence number of the newest event"""
+        events = self.read()
+        return events[-1]['seq'] if events else 0
+
+    def since(self, seq):
+        """returns all events newer than seq. If events in between were
+        already dropped from the log (or the log was reset), a single 'reset'
+        event is returned, telling the client to reload its whole state."""
+        events = self.read()
+        if not events or events[-1]['seq'] <= seq:
+            if events and events[-1]['seq'] < seq:
+                return [{'seq': events[-1]['seq'], 'time': time.time(), 'type': 'reset', 'data': None}]
+            return []
+        if events[0]['seq'] > seq + 1:
+            return [{'seq': events[-1]['seq'], 'time': time.time(), 'type': 'reset', 'data': None}]
+        return [event for event in events if event['seq'] > seq]
+
+    def wait(self, seq, timeout):
+        """blocks until there are events newer than seq or the timeout
+        passed, then returns them (empty list on timeout)"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                events = self.since(seq)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                # events of other processes are noticed within poll_interval
+                self.condition.wait(min(self.poll_interval, remaining))
+
+    def read(self):
+        """returns the events in the log file, which is only parsed again
+        if it changed since the last call"""
+        try:
+            stat = os.stat(self.log_file)
+        except OSError:
+            self.events, self.stamp = [], None
+            return self.events
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if stamp != self.stamp:
+            events = []
+            with open(self.log_file) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # skip lines which were cut off by a crash
+                        continue
+            self.events, self.stamp = events, stamp
+        return self.events
+
+    def write(self, events):
+        temp_file = self.log_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            share(f)
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+        os.rename(temp_file, self.log_file)
@@ -0,0 +1,67 @@
+"""selects the hardware backends: the real ones on the raspberry pi, the
+simulated ones of modules/simulator.py if smart_alarm_simulate is 1"""
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+simulate = os.environ.get('smart_alarm_simulate') == '1'
+
+if simulate:
+    from modules import simulator
+    GPIO = simulator.GPIO
+    if os.environ.get('smart_alarm_simulate_script'):
+        GPIO.run_script(os.environ['smart_alarm_simulate_script'])
+else:
+    import RPi.GPIO as GPIO
+
+
+def alphanum_display():
+    """the alphanumeric display driver"""
+    if simulate:
+        return simulator.RecordingDisplay()
+    from Adafruit_LED_Backpack import AlphaNum4
+    return AlphaNum4.AlphaNum4()
+
+
+def digit_values():
+    """segment masks of the characters"""
+    if simulate:
+        return simulator.DIGIT_VALUES
+    from Adafruit_LED_Backpack import AlphaNum4
+    return AlphaNum4.DIGIT_VALUES
+
+
+def audio_sink():
+    if simulate:
+        return simulator.audio_sink()
+    from modules.audio_engine import PygameSink
+    return PygameSink()
+
+
+def speech_cache(rate):
+    if simulate:
+        return simulator.NullSpeech()
+    from modules.speech import SpeechCache
+    return SpeechCache(rate=rate)
+
+
+def stream_decoder():
+    """command playing mp3 data from stdin"""
+    if simulate:
+        return ('sh', '-c', 'exec cat > /dev/null')
+    return ('mpg123', '-q', '-')
+
+
+def led_sink():
+    """the spi bus of the apa102 strip. The leds are optional: without the
+    spi device the frames go to a sink without output"""
+    if simulate:
+        return simulator.RecordingStrip()
+    from modules.led_engine import SpiSink, FakeSpiSink
+    try:
+        return SpiSink()
+    except (ImportError, IOError, OSError) as e:
+        logger.info('no led strip found, the led frames are not shown: {}'.format(e))
+        return FakeSpiSink()
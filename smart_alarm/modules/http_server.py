@@ -0,0 +1,411 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import Queue
+import socket
+import urllib
+import time
+import sys
+import logging
+
+from wsgiref.util import FileWrapper
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    """raised for requests which are answered with an error right away"""
+
+    def __init__(self, status, message=''):
+        super(RequestError, self).__init__(message or status)
+        self.status = status
+
+
+class BodyReader(object):
+    """
+    wsgi.input of one request: reads at most the content length, so the
+    next request on a kept-alive connection stays untouched, or decodes a
+    chunked body. Raises RequestError if the body is larger than max_size.
+    """
+
+    def __init__(self, rfile, length=None, chunked=False, max_size=None):
+        self.rfile = rfile
+        self.remaining = length or 0
+        self.chunked = chunked
+        self.max_size = max_size
+        self.received = 0
+        self.done = not chunked and not length
+
+    def read(self, size=-1):
+        chunks = []
+        while not self.done and (size < 0 or size > 0):
+            if self.chunked and self.remaining == 0:
+                self.next_chunk()
+                continue
+            part = self.rfile.read(self.remaining if size < 0 else min(size, self.remaining))
+            if not part:
+                raise RequestError('400 Bad Request', 'request body ended early')
+            self.remaining -= len(part)
+            if size > 0:
+                size -= len(part)
+            chunks.append(part)
+            if self.chunked and self.remaining == 0:
+                # the crlf after the chunk data
+                self.rfile.readline(8)
+            elif not self.chunked and self.remaining == 0:
+                self.done = True
+        return b''.join(chunks)
+
+    def next_chunk(self):
+        line = self.rfile.readline(1024)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestError('400 Bad Request', 'invalid chunk size')
+        if size == 0:
+            # skip the trailers until the empty line
+            while self.rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                pass
+            self.done = True
+            return
+        self.received += size
+        if self.max_size is not None and self.received > self.max_size:
+            raise RequestError('413 Request Entity Too Large')
+        self.remaining = size
+
+    def readline(self, size=-1):
+        # only used by the cgi module for form posts, which are small
+        line = []
+        while not self.done and (size < 0 or len(line) < size):
+            char = self.read(1)
+            line.append(char)
+            if char == b'\n':
+                break
+        return b''.join(line)
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        """reads the rest of the body, so the connection can be reused.
+        Returns False if more than limit bytes were left."""
+        left = limit
+        while not self.done:
+            part = self.read(min(64 * 1024, left + 1))
+            left -= len(part)
+            if left < 0:
+                return False
+        return True
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    runs the wsgi application for every request of a connection. Speaks
+    HTTP/1.1 with keep-alive: responses without content length are sent
+    chunked, and the unread rest of a request body is skipped before the
+    next request.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'smart_alarm'
+    # headers and body leave in one segment when the response is flushed,
+    # small writes are not held back waiting for the client's delayed ack
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.track(self.connection, busy=False)
+
+    def finish(self):
+        self.server.untrack(self.connection)
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        self.server.track(self.connection, busy=True)
+        # uploads may stall for a while, idle connections may not
+        self.connection.settimeout(self.server.request_timeout)
+        try:
+            if len(self.raw_requestline) > 65536:
+                self.send_error(414)
+                self.close_connection = 1
+                return
+            if not self.parse_request():
+                return
+            self.run_application()
+        finally:
+            try:
+                self.wfile.flush()
+            except socket.error:
+                self.close_connection = 1
+            if self.server.stopping:
+                self.close_connection = 1
+            self.connection.settimeout(self.server.keep_alive_timeout)
+            self.server.track(self.connection, busy=False)
+
+    def run_application(self):
+        try:
+            body = self.body_reader()
+        except RequestError as e:
+            self.send_simple_response(e.status, str(e))
+            self.close_connection = 1
+            return
+
+        environ = self.environ(body)
+        state = {'status': None, 'headers': None, 'sent': False, 'chunked': False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif state['status'] is not None:
+                raise AssertionError('start_response called twice')
+            state['status'], state['headers'] = status, headers
+            return lambda data: self.write_body(state, data)
+
+        result = None
+        try:
+            result = self.server.application(environ, start_response)
+            for data in result:
+                if data:
+                    self.write_body(state, data)
+            if not state['sent']:
+                self.send_headers(state)
+            if state['chunked']:
+                self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except RequestError as e:
+            if not state['sent']:
+                self.send_simple_response(e.status, str(e))
+            self.close_connection = 1
+        except socket.error:
+            self.close_connection = 1
+        except Exception:
+            logger.exception('request {} failed'.format(self.path))
+            if not state['sent']:
+                self.send_simple_response('500 Internal Server Error', '')
+            self.close_connection = 1
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not self.close_connection:
+            try:
+                if not body.drain(self.server.max_drain_size):
+                    self.close_connection = 1
+            except (RequestError, socket.error):
+                self.close_connection = 1
+
+    def body_reader(self):
+        chunked = 'chunked' in self.headers.get('transfer-encoding', '').lower()
+        length = self.headers.get('content-length')
+        if length is not None and not chunked:
+            try:
+                length = int(length)
+            except ValueError:
+                raise RequestError('400 Bad Request', 'invalid content length')
+            if length < 0:
+                raise RequestError('400 Bad Request', 'invalid content length')
+            if length > self.server.max_body_size:
+                raise RequestError('413 Request Entity Too Large')
+        if self.headers.get('expect', '').lower() == '100-continue':
+            self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            self.wfile.flush()
+        return BodyReader(self.rfile, length, chunked, self.server.max_body_size)
+
+    def environ(self, body):
+        path, _, query = self.path.partition('?')
+        environ = dict(self.server.base_environ)
+        environ.update({
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': self.headers.get('content-type', ''),
+            'CONTENT_LENGTH': self.headers.get('content-length', ''),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.file_wrapper': FileWrapper,
+        })
+        for name, value in self.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+        return environ
+
+    def send_headers(self, state):
+        status, headers = state['status'], state['headers']
+        if status is None:
+            raise AssertionError('write before start_response')
+        names = set(name.lower() for name, _ in headers)
+        lines = ['{} {}'.format(self.protocol_version, status)]
+        lines += ['{}: {}'.format(name, value) for name, value in headers]
+        if 'content-length' not in names and not status.startswith(('204', '304')):
+            if self.request_version == 'HTTP/1.1':
+                state['chunked'] = True
+                lines.append('Transfer-Encoding: chunked')
+            else:
+                self.close_connection = 1
+        if self.request_version != 'HTTP/1.1' and not self.close_connection:
+            if self.headers.get('connection', '').lower() == 'keep-alive':
+                lines.append('Connection: keep-alive')
+            else:
+                self.close_connection = 1
+        if self.close_connection or self.server.stopping:
+            lines.append('Connection: close')
+            self.close_connection = 1
+        lines += ['Date: {}'.format(self.date_time_string()), 'Server: {}'.format(self.server_version)]
+        self.wfile.write('\r\n'.join(lines) + '\r\n\r\n')
+        state['sent'] = True
+        self.log_request(status.split(' ', 1)[0])
+
+    def write_body(self, state, data):
+        if not state['sent']:
+            self.send_headers(state)
+        if state['chunked']:
+            self.wfile.write('{:x}\r\n'.format(len(data)) + data + '\r\n')
+        else:
+            self.wfile.write(data)
+
+    def send_simple_response(self, status, message):
+        body = message + '\n'
+        state = {'status': status, 'headers': [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))],
+                 'sent': False, 'chunked': False}
+        self.close_connection = 1
+        self.write_body(state, body)
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.client_address[0], format % args))
+
+
+class ThreadPoolServer(SocketServer.TCPServer):
+    """
+    http server for a wsgi application, handling the connections with a
+    fixed pool of worker threads. stop() stops accepting connections, lets
+    the requests in progress finish within grace_period seconds and closes
+    the idle kept-alive connections.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 32
+
+    def __init__(self, address, application, threads=8, max_body_size=32 * 1024 * 1024, keep_alive_timeout=5,
+                 request_timeout=60, max_drain_size=64 * 1024, grace_period=10):
+        SocketServer.TCPServer.__init__(self, address, WSGIRequestHandler)
+        self.application = application
+        self.max_body_size = max_body_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.request_timeout = request_timeout
+        self.max_drain_size = max_drain_size
+        self.grace_period = grace_period
+        self.stopping = False
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        host, port = self.server_address[:2]
+        self.base_environ = {
+            'SERVER_NAME': socket.getfqdn(host),
+            'SERVER_PORT': str(port),
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        self.workers = []
+        for number in range(threads):
+            worker = threading.Thread(target=self.work, name='http worker {}'.format(number))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        # called by the accepting thread, the connection waits for a free worker
+        self.queue.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logger.exception('connection of {} failed'.format(client_address[0]))
+
+    def track(self, connection, busy):
+        with self.lock:
+            self.connections[connection] = busy
+        if self.stopping and not busy:
+            close_reading(connection)
+
+    def untrack(self, connection):
+        with self.lock:
+            self.connections.pop(connection, None)
+
+    def serve(self):
+        """serves until stop() is called from another thread (or a signal
+        handler)"""
+        logger.info('serving on port {} with {} threads'.format(self.server_address[1], len(self.workers)))
+        try:
+            self.serve_forever()
+        finally:
+            self.drain()
+
+    def stop(self):
+        self.stopping = True
+        # serve_forever() waits for this, so don't block a signal handler
+        threading.Thread(target=self.shutdown, name='http shutdown').start()
+
+    def drain(self):
+        """closes the idle connections and waits for the busy ones"""
+        self.server_close()
+        with self.lock:
+            idle = [connection for connection, busy in self.connections.items() if not busy]
+        for connection in idle:
+            close_reading(connection)
+        for _ in self.workers:
+            self.queue.put(None)
+        deadline = time.time() + self.grace_period
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+        with self.lock:
+            left = len(self.connections)
+        if left:
+            logger.warning('{} requests were still running at shutdown'.format(left))
+        logger.info('server stopped')
+
+
+def close_reading(connection):
+    """wakes up a worker waiting for the next request on connection"""
+    try:
+        connection.shutdown(socket.SHUT_RD)
+    except socket.error:
+        pass
@@ -1,10 +1,9 @@
-import time
 import os
-import sys
-sys.path.append(os.path.abspath("/home/pi/APA102_Pi"))
-import colorschemes
 import logging
 
+from modules import hardware
+from modules import led_engine
+
 
 # read environmental variable for project path
 project_path = os.environ['smart_alarm_path']
@@ -14,38 +13,43 @@ logger = logging.getLogger(__name__)
 class LEDs(object):
     """
     LEDs class: manages the implementation of the 'wake-up'-leds.
-    Makes us of tinues APA102_Pi library: https://github.com/tinue/APA102_Pi
+    The frames are computed in advance by the led engine and written by
+    one persistent APA102 writer thread.
     """
 
-    def __init__(self):
-        """init functions: set variables and start adafruit dotstar class"""
+    def __init__(self, sink=None):
+        """init functions: set variables and open the led output"""
         # write to error.log file
         logger.info('led-module initialized')
         self.number_of_leds = 9
         self.stop_led = False
-        self.leds_active = False
+        self.writer = led_engine.LEDWriter(sink or hardware.led_sink(), self.number_of_leds)
+        # sequences don't change, so compute them only once
+        self.sequences = {}
+
+    @property
+    def leds_active(self):
+        return self.writer.busy()
 
     def stopping_leds(self):
         """stops leds when button is pressed"""
         logger.debug('leds are being stopped')
         logger.debug('now stopping leds')
         self.stop_led = True
+        self.writer.stop()
+
+    def sequence(self, name, function, *args):
+        if (name, args) not in self.sequences:
+            self.sequences[name, args] = function(self.number_of_leds, *args)
+        return self.sequences[name, args]
 
     def rainbow(self, brightness, duration_time):
         """colorful rainbow cycling through all leds"""
         if self.stop_led:
             logger.debug('skipping led rainbow, since button was pressed')
             return
-        logger.debug('running led rainbow with brightness {}/10 for {}sec'.format(brightness, duration_time))
-        self.leds_active = True
-        clock = 0
-        start = time.time()
-        while clock < duration_time and self.stop_led is False:
-            rainbow = colorschemes.Rainbow(numLEDs=self.number_of_leds, pauseValue=0.02, numStepsPerCycle=255,
-                                           numCycles=1, globalBrightness=brightness)
-            rainbow.start()
-            clock = time.time() - start
-        self.leds_active = False
+        logger.debug('running led rainbow with brightness {}/31 for {}sec'.format(brightness, duration_time))
+        self.writer.play(self.sequence('rainbow', led_engine.rainbow, brightness), duration_time).wait()
 
     def white_blinking(self, duration_time):
         """most bright white blinking, finally you should wake up"""
@@ -53,20 +57,19 @@ class LEDs(object):
             logger.debug('skipping led white blinking, since button was pressed')
             return
         logger.debug('running led white blinking')
-        self.leds_active = True
-        clock = 0
-        start = time.time()
-        while clock < duration_time and self.stop_led is False:
-            blinking = colorschemes.Solid(numLEDs=self.number_of_leds, pauseValue=0.05, numStepsPerCycle=1,
-                                          numCycles=1)
-            blinking.start()
-            time.sleep(0.05)
-            clock = time.time() - start
-        self.leds_active = False
+        self.writer.play(self.sequence('blinking', led_engine.blinking), duration_time).wait()
 
-    def wake_up_light_show(self, duration_time):
-        """combination of earlier functions, adjust when needed"""
-        self.rainbow(1, duration_time/4)
-        self.rainbow(3, duration_time/4)
-        self.rainbow(10, duration_time/4)
-        self.white_blinking(duration_time/4)
+    def wake_up_light_show(self, duration_time, hold_time=0):
+        """sunrise within duration_time, the leds go off at the end. With a
+        hold_time the light stays on until the button is pressed, but at
+        most hold_time seconds"""
+        if self.stop_led:
+            logger.debug('skipping led sunrise, since button was pressed')
+            return
+        logger.debug('running led sunrise for {}sec'.format(duration_time))
+        # the sunrise is long, it is not kept
+        done = self.writer.play(led_engine.sunrise(self.number_of_leds, duration_time), hold=hold_time > 0)
+        if not hold_time:
+            done.wait()
+        elif not done.wait(duration_time + hold_time):
+            self.writer.stop()
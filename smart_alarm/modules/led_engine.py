@@ -0,0 +1,231 @@
+import numpy as np
+import threading
+import time
+import logging
+
+from collections import deque
+
+from modules.clock import monotonic
+
+try:
+    import spidev
+except ImportError:
+    spidev = None
+
+
+logger = logging.getLogger(__name__)
+
+# gamma correction of the 8 bit color values, the eye is more sensitive to
+# changes of dark colors than of bright ones
+GAMMA = np.round((np.arange(256) / 255.0) ** 2.2 * 255).astype(np.uint8)
+
+# colors of the sunrise at the given progress (0 - 1), linear rgb before gamma
+SUNRISE_POSITIONS = [0.0, 0.15, 0.4, 0.7, 1.0]
+SUNRISE_COLORS = [(0, 0, 0), (60, 0, 0), (200, 40, 0), (255, 120, 20), (255, 200, 120)]
+
+
+class Sequence(object):
+    """
+    precomputed led frames, already encoded as apa102 spi data: one row of
+    bytes per frame, played at fps frames per second
+    """
+
+    def __init__(self, data, fps, name='sequence'):
+        self.data = data
+        self.fps = fps
+        self.name = name
+
+    def __len__(self):
+        return len(self.data)
+
+
+def encode(colors, brightness=31):
+    """encodes frames of rgb colors (array of shape frames x leds x 3) into
+    apa102 spi data: start frame, [0xE0 | brightness, blue, green, red] per
+    led, end frame. brightness is the 5 bit global brightness, either one
+    value or one per frame."""
+    frame_count, led_count, _ = colors.shape
+    end_frame = (led_count + 15) // 16
+    data = np.zeros((frame_count, 4 + 4 * led_count + end_frame), dtype=np.uint8)
+    leds = data[:, 4:4 + 4 * led_count].reshape(frame_count, led_count, 4)
+    brightness = np.clip(np.asarray(brightness, dtype=np.int32), 0, 31)
+    leds[:, :, 0] = (0xE0 | brightness).reshape(-1, 1) if brightness.ndim else 0xE0 | int(brightness)
+    leds[:, :, 1:] = GAMMA[colors[:, :, ::-1]]
+    return data
+
+
+def hsv_to_rgb(hue, saturation=1.0, value=1.0):
+    """vectorized hsv -> rgb, hue as array in 0 - 1, returns uint8 rgb"""
+    hue = np.asarray(hue, dtype=np.float64) % 1.0
+    sector = np.floor(hue * 6).astype(np.int32) % 6
+    fraction = hue * 6 - np.floor(hue * 6)
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * fraction)
+    t = value * (1 - saturation * (1 - fraction))
+    v = np.full_like(hue, value)
+    p = np.full_like(hue, p)
+    red = np.choose(sector, [v, q, p, p, t, v])
+    green = np.choose(sector, [t, v, v, q, p, p])
+    blue = np.choose(sector, [p, p, t, v, v, q])
+    return np.round(np.stack([red, green, blue], axis=-1) * 255).astype(np.uint8)
+
+
+def rainbow(led_count, brightness=31, cycle_time=5.0, fps=50):
+    """one cycle of a rainbow moving through the leds"""
+    frame_count = max(int(cycle_time * fps), 1)
+    hue = np.arange(frame_count).reshape(-1, 1) / float(frame_count) + np.arange(led_count) / float(led_count)
+    return Sequence(encode(hsv_to_rgb(hue), brightness), fps, 'rainbow')
+
+
+def sunrise(led_count, duration, fps=25):
+    """smooth sunrise from dark over red and orange to warm white. The
+    global brightness rises with the colors, so the first minutes stay
+    really dim."""
+    frame_count = max(int(duration * fps), 1)
+    progress = np.linspace(0.0, 1.0, frame_count)
+    colors = np.empty((frame_count, led_count, 3), dtype=np.uint8)
+    for channel in range(3):
+        values = np.interp(progress, SUNRISE_POSITIONS, [color[channel] for color in SUNRISE_COLORS])
+        colors[:, :, channel] = np.round(values).reshape(-1, 1)
+    brightness = np.ceil(progress ** 2 * 31).astype(np.int32)
+    return Sequence(encode(colors, brightness), fps, 'sunrise')
+
+
+def blinking(led_count, color=(255, 255, 255), period=0.1, fps=20):
+    """one blink: on for half the period, off for the other half"""
+    frame_count = max(int(period * fps), 2)
+    colors = np.zeros((frame_count, led_count, 3), dtype=np.uint8)
+    colors[:frame_count // 2] = color
+    return Sequence(encode(colors), fps, 'blinking')
+
+
+def off_frame(led_count):
+    return encode(np.zeros((1, led_count, 3), dtype=np.uint8))[0]
+
+
+class LEDWriter(object):
+    """
+    plays led sequences on one persistent output (the spi device is opened
+    once) from its own thread. Frame n of a sequence is written at
+    start + n / fps of the monotonic clock; frames which are already late
+    are skipped, so the sequences keep their duration.
+    """
+
+    def __init__(self, sink, led_count):
+        self.sink = sink
+        self.led_count = led_count
+        self.off = off_frame(led_count).tobytes()
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.active = False
+        self.frames = self.dropped_frames = 0
+        self.thread = threading.Thread(target=self.run, name='led writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, sequence, duration=None, hold=False):
+        """queues the sequence, repeated for duration seconds (once if
+        None). With hold the last frame stays on until stop(). Returns an
+        Event which is set when the sequence is done."""
+        done = threading.Event()
+        with self.condition:
+            self.queue.append((sequence, duration, hold, done))
+            self.active = True
+            self.condition.notify()
+        return done
+
+    def stop(self):
+        """ends the current sequence, drops the queued ones and switches the
+        leds off"""
+        with self.condition:
+            dropped = list(self.queue)
+            self.queue.clear()
+            self.cancelled = True
+            self.condition.notify()
+        for _, _, _, done in dropped:
+            done.set()
+
+    def busy(self):
+        with self.condition:
+            return self.active
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.active = False
+                    self.condition.wait()
+                sequence, duration, hold, done = self.queue.popleft()
+                self.cancelled = False
+            try:
+                self.render(sequence, duration)
+                if hold:
+                    with self.condition:
+                        while not self.cancelled and not self.queue:
+                            self.condition.wait()
+            except Exception as e:
+                logger.error('playing led sequence {} failed: {}'.format(sequence.name, e))
+            finally:
+                with self.condition:
+                    last = not self.queue
+                if last or self.cancelled:
+                    self.sink.write(self.off)
+                done.set()
+
+    def render(self, sequence, duration):
+        frame_count = len(sequence) if duration is None else int(duration * sequence.fps)
+        start = monotonic()
+        number = 0
+        while number < frame_count and not self.cancelled:
+            self.sink.write(sequence.data[number % len(sequence)].tobytes())
+            self.frames += 1
+            number += 1
+            deadline = start + number / float(sequence.fps)
+            now = monotonic()
+            if now < deadline:
+                time.sleep(deadline - now)
+            elif now > deadline + 1.0 / sequence.fps:
+                late = int((now - deadline) * sequence.fps)
+                self.dropped_frames += late
+                number += late
+
+
+class SpiSink(object):
+    """writes frames to the apa102 strip through spidev, opened once"""
+
+    def __init__(self, bus=0, device=1, speed_hz=8000000):
+        if spidev is None:
+            raise ImportError('spidev is needed to drive the leds')
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = speed_hz
+
+    def write(self, data):
+        self.spi.writebytes(list(bytearray(data)))
+
+    def close(self):
+        self.spi.close()
+
+
+class FakeSpiSink(object):
+    """
+    spi sink without hardware for tests and benchmarks. Counts frames and
+    bytes, keeps the last frame and optionally takes as long as the real
+    bus would need at speed_hz.
+    """
+
+    def __init__(self, speed_hz=None):
+        self.speed_hz = speed_hz
+        self.frames = self.bytes = 0
+        self.last_frame = None
+
+    def write(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+        self.last_frame = data
+        if self.speed_hz:
+            time.sleep(len(data) * 8.0 / self.speed_hz)
+
+    def close(self):
+        pass
@@ -0,0 +1,219 @@
+import logging.handlers
+import threading
+import logging
+import atexit
+import time
+import sys
+
+from collections import deque
+
+from modules.wakeup import Wakeup
+
+
+# renders the tracebacks on the caller thread
+exception_formatter = logging.Formatter()
+
+class LogPipeline(logging.Handler):
+    """
+    asynchronous front of the log handlers. emit() only appends the record
+    to a queue, a background thread hands the records to the target
+    handlers in batches, every flush_interval seconds or as soon as
+    batch_size records are waiting. Repeated messages are collapsed into
+    one 'repeated n times' line and every source line may log at most
+    max_per_minute records per minute, errors are never held back. All
+    records, including the ones filtered out, are kept in a ring buffer,
+    which is dumped to dump_file when an error is logged.
+    """
+
+    def __init__(self, targets, flush_interval=5.0, batch_size=200, max_queue=10000, max_per_minute=30,
+                 repeat_interval=60.0, ring_size=1000, dump_file=None, dump_formatter=None, dump_interval=60.0):
+        logging.Handler.__init__(self)
+        self.targets = list(targets)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.max_per_minute = max_per_minute
+        self.repeat_interval = repeat_interval
+        self.dump_file = dump_file
+        self.dump_formatter = dump_formatter or logging.Formatter()
+        self.dump_interval = dump_interval
+        self.last_dump = None
+        self.queue = deque()
+        self.ring = deque(maxlen=ring_size)
+        # a pipe, a timed wait of threading.Event polls in python 2
+        self.wakeup = Wakeup()
+        # (key, record, first repetition, number of repetitions) of the last message
+        self.last = (None, None, None, 0)
+        # per source line: [start of the minute, records in it, suppressed records]
+        self.sources = {}
+        self.emitted = self.dropped = self.suppressed = self.batches = self.dumps = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='log pipeline')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """writes the waiting records and ends the background thread"""
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.notify()
+        self.thread.join(5)
+
+    def handle(self, record):
+        # the queue is thread safe, so unlike logging.Handler no lock is taken
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def emit(self, record):
+        # runs on the caller thread: no formatting and no i/o, exceptions are
+        # rendered right away since the traceback is gone later
+        if record.exc_info and not record.exc_text:
+            record.exc_text = exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+        self.emitted += 1
+        if record.levelno >= logging.ERROR or len(self.queue) >= self.batch_size:
+            self.wakeup.notify()
+
+    def flush(self):
+        self.wakeup.notify()
+
+    def stats(self):
+        return {'emitted': self.emitted, 'dropped': self.dropped, 'suppressed': self.suppressed,
+                'batches': self.batches, 'dumps': self.dumps, 'waiting': len(self.queue)}
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.process()
+        self.process()
+
+    def process(self):
+        """hands the waiting records to the targets and flushes them once"""
+        batch = []
+        error = False
+        while self.queue:
+            record = self.queue.popleft()
+            self.ring.append(record)
+            batch.extend(self.filter_record(record))
+            error = error or record.levelno >= logging.ERROR
+        batch.extend(self.pending_summaries())
+        if batch:
+            self.batches += 1
+            for target in self.targets:
+                for record in batch:
+                    if record.levelno >= target.level:
+                        target.handle(record)
+                try:
+                    getattr(target, 'flush_batch', target.flush)()
+                except Exception as e:
+                    self.report_error(e)
+        if error:
+            self.dump()
+
+    def filter_record(self, record):
+        """returns the records to write instead of record: none if it is
+        suppressed, otherwise record, maybe after a repetition summary"""
+        if record.levelno >= logging.ERROR:
+            return self.flush_repeats() + [record]
+        key = (record.name, record.levelno, record.getMessage())
+        last_key, last_record, first_repeat, repeats = self.last
+        if key == last_key:
+            self.suppressed += 1
+            self.last = (last_key, last_record, first_repeat or record.created, repeats + 1)
+            return []
+        records = self.flush_repeats()
+        self.last = (key, record, None, 0)
+
+        source = self.sources.get((record.pathname, record.lineno))
+        if source is None or record.created - source[0] >= 60:
+            if source is not None and source[2]:
+                records.append(self.summary(record, logging.INFO, 'suppressed {} more messages from {}:{} '
+                                                                  'within a minute'.format(source[2], record.filename,
+                                                                                           record.lineno)))
+            source = self.sources[record.pathname, record.lineno] = [record.created, 0, 0]
+        source[1] += 1
+        if source[1] > self.max_per_minute:
+            source[2] += 1
+            self.suppressed += 1
+            return records
+        return records + [record]
+
+    def flush_repeats(self):
+        last_key, record, first_repeat, repeats = self.last
+        if not repeats:
+            return []
+        self.last = (last_key, record, None, 0)
+        return [self.summary(record, record.levelno, 'last message repeated {} times: {}'.format(
+            repeats, last_key[2]))]
+
+    def pending_summaries(self):
+        """reports repetitions which are going on for repeat_interval"""
+        last_key, record, first_repeat, repeats = self.last
+        if repeats and time.time() - first_repeat >= self.repeat_interval:
+            return self.flush_repeats()
+        return []
+
+    def summary(self, record, level, message):
+        """a record of the pipeline about record"""
+        return logging.LogRecord(record.name, level, record.pathname, record.lineno, message, None, None,
+                                 record.funcName)
+
+    def dump(self):
+        """writes the recent records of all levels to dump_file, at most
+        once per dump_interval"""
+        if self.dump_file is None:
+            return
+        if self.last_dump is not None and time.time() - self.last_dump < self.dump_interval:
+            return
+        self.last_dump = time.time()
+        try:
+            with open(self.dump_file, 'a') as f:
+                f.write('---- last {} log records before the error ----\n'.format(len(self.ring)))
+                for record in self.ring:
+                    f.write(self.dump_formatter.format(record) + '\n')
+            self.dumps += 1
+        except (IOError, OSError) as e:
+            self.report_error(e)
+
+    def report_error(self, error):
+        sys.stderr.write('log pipeline: {}\n'.format(error))
+
+
+class BatchFileHandler(logging.handlers.RotatingFileHandler):
+    """rotating log file which is flushed once per batch of the log
+    pipeline instead of after every record"""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+def start_pipeline(logger=None, **options):
+    """moves the file handlers of logger (the root logger by default) behind
+    a log pipeline and returns it. Console handlers stay synchronous, so
+    their output is neither delayed nor filtered."""
+    logger = logger or logging.getLogger()
+    files = [handler for handler in logger.handlers if isinstance(handler, logging.FileHandler)]
+    pipeline = LogPipeline(files, **options)
+    logger.handlers = [handler for handler in logger.handlers if handler not in files] + [pipeline]
+    return pipeline.start()
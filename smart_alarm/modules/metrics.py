@@ -0,0 +1,189 @@
+import threading
+import bisect
+import json
+import time
+import os
+import logging
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+# every metric name starts with this
+prefix = 'smart_alarm_'
+
+# upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the throughput histograms in bytes per second
+THROUGHPUT_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6)
+# upper bounds of the main loop tick jitter in seconds
+JITTER_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+
+# the daemon writes its metrics to this file, the web server reads them. It
+# is rewritten every few seconds, so it is kept on the tmpfs /run instead of
+# the sd card if autostart.sh created run_path
+run_path = '/run/smart_alarm'
+daemon_file = (run_path if os.path.isdir(run_path) else project_path) + '/metrics.json'
+
+
+class Registry(object):
+    """
+    counters, gauges and histograms of one process. Updating a metric is a
+    dict lookup and an addition under a lock, cheap enough for the hot
+    paths. Metrics are created on first use, describe() adds the help text
+    and the histogram buckets. snapshot() returns everything as plain json
+    data, which the daemon writes to a file for the web server.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # name: (help text, buckets)
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, help_text, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            self.descriptions[name] = (help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_string(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name, label_string(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_string(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                buckets = self.descriptions.get(name, (None, LATENCY_BUCKETS))[1]
+                histogram = self.histograms[key] = [list(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+            bounds, counts = histogram[0], histogram[1]
+            counts[bisect.bisect_left(bounds, value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self):
+        """returns all metrics as {'counter': [[name, labels, value]],
+        'gauge': [...], 'histogram': [[name, labels, buckets, counts,
+        sum, count]], 'help': {name: text}, 'time': now}"""
+        with self.lock:
+            return {'counter': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                    'gauge': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                    'histogram': [[name, labels, h[0], list(h[1]), h[2], h[3]]
+                                  for (name, labels), h in self.histograms.items()],
+                    'help': dict((name, d[0]) for name, d in self.descriptions.items()),
+                    'time': time.time()}
+
+    def write(self, path):
+        """writes the snapshot to path, replacing the file atomically"""
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(temp_file, path)
+
+
+class SnapshotFile(object):
+    """reads the snapshot another process wrote, parsed again only if the
+    file changed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.data = None
+
+    def read(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.data, self.stamp = None, None
+            return None
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if stamp != self.stamp:
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+            except (IOError, ValueError) as e:
+                logger.warning('reading metrics of {} failed: {}'.format(self.path, e))
+                return self.data
+            self.stamp = stamp
+        return self.data
+
+
+def label_string(labels):
+    """{'path': '/upload'} -> 'path="/upload"', sorted by label name"""
+    if not labels:
+        return ''
+    return ','.join('{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items()))
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def join_labels(*label_strings):
+    return ','.join(labels for labels in label_strings if labels)
+
+
+def sample(name, labels, value):
+    return '{}{} {}'.format(prefix + name, '{' + labels + '}' if labels else '', repr(float(value)))
+
+
+def render(snapshots):
+    """renders the snapshots of several processes in the prometheus text
+    format. snapshots is a list of (process name, snapshot), every sample
+    gets a process label."""
+    metrics = {}
+    help_texts = {}
+    for process, snapshot in snapshots:
+        process_label = label_string({'process': process})
+        help_texts.update(snapshot['help'])
+        for kind in ('counter', 'gauge'):
+            for name, labels, value in snapshot[kind]:
+                metrics.setdefault((name, kind), []).append(sample(name, join_labels(process_label, labels), value))
+        for name, labels, buckets, counts, total, count in snapshot['histogram']:
+            lines = metrics.setdefault((name, 'histogram'), [])
+            labels = join_labels(process_label, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format(bound if bound == '+Inf' else repr(float(bound)))
+                lines.append(sample(name + '_bucket', join_labels(labels, le), cumulative))
+            lines.append(sample(name + '_sum', labels, total))
+            lines.append(sample(name + '_count', labels, count))
+
+    output = []
+    for name, kind in sorted(metrics):
+        if name in help_texts:
+            output.append('# HELP {}{} {}'.format(prefix, name, help_texts[name]))
+        output.append('# TYPE {}{} {}'.format(prefix, name, kind))
+        output.extend(metrics[name, kind])
+    return '\n'.join(output) + '\n'
+
+
+# metrics of this process
+registry = Registry()
+registry.describe('http_requests_total', 'web requests by path, method and status')
+registry.describe('http_request_duration_seconds', 'time until the web application returned the response')
+registry.describe('upload_bytes_total', 'bytes of uploaded mp3 files')
+registry.describe('upload_throughput_bytes_per_second', 'throughput of the upload requests', THROUGHPUT_BUCKETS)
+registry.describe('settings_writes_total', 'writes of data.xml by the web server')
+registry.describe('daemon_metrics_age_seconds', 'age of the metrics file written by the alarm daemon')
+registry.describe('startup_seconds', 'seconds from the start of the daemon process until the startup step')
+registry.describe('tick_jitter_seconds', 'delay of the main loop tick after the full second', JITTER_BUCKETS)
+registry.describe('display_frames_total', 'frames flushed to the display, including unchanged ones')
+registry.describe('display_frames_skipped_total', 'unchanged frames, which were not sent')
+registry.describe('display_i2c_transactions_total', 'i2c transactions to the display')
+registry.describe('display_i2c_bytes_total', 'bytes sent to the display, including address and register')
+registry.describe('download_bytes_total', 'downloaded bytes of podcast feeds, episodes and streams')
+registry.describe('download_throughput_bytes_per_second', 'throughput of the podcast downloads (streams are '
+                                                          'throttled by the playback)', THROUGHPUT_BUCKETS)
+registry.describe('cache_requests_total', 'lookups of the podcast and speech cache, the hit ratio is '
+                                          'hit / (hit + miss)')
+registry.describe('audio_stop_latency_seconds', 'time from pressing stop until the audio backend was silent')
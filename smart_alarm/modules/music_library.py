@@ -0,0 +1,158 @@
+import sqlite3
+import threading
+import os
+import logging
+
+from stat import S_ISREG
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+default_music_path = project_path + '/music'
+default_db_file = project_path + '/music_library.db'
+
+
+class MusicLibrary(object):
+    """
+    persistent index of the files in the music directory. Every track is stored
+    in a sqlite database together with its mtime, size and (if mutagen is
+    installed) duration, bitrate and tags. The index is updated incrementally,
+    so listing tracks or picking a random one never touches the filesystem.
+    """
+
+    def __init__(self, music_path=default_music_path, db_file=default_db_file):
+        self.music_path = music_path
+        self.db_file = db_file
+        # the connection is shared between the threads of the web server
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS tracks ('
+                                    'name TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                                    'duration REAL, bitrate INTEGER, '
+                                    'title TEXT, artist TEXT, album TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        logger.info('music library initialized')
+
+    def sync(self):
+        """compares the music directory with the index and updates new, changed
+        and deleted files. Does nothing but a single stat call if the directory
+        did not change since the last sync. Returns True if the index changed."""
+        # repr keeps every digit of the mtime, str of a bare float in
+        # python 2 rounds it to 12 digits (10 ms)
+        directory_stamp = repr(stamp(self.music_path))
+        if directory_stamp == self.state('directory_stamp'):
+            return False
+
+        indexed = dict((row[0], (row[1], row[2])) for row in
+                       self.query('SELECT name, mtime, size FROM tracks'))
+        changed = False
+        on_disk = set()
+        for name in os.listdir(self.music_path):
+            file_stamp = stamp(os.path.join(self.music_path, name), regular_file=True)
+            if file_stamp is None:
+                continue
+            on_disk.add(name)
+            if indexed.get(name) != file_stamp[:2]:
+                self.add(name)
+                changed = True
+
+        for name in set(indexed) - on_disk:
+            self.remove(name)
+            changed = True
+
+        self.set_state('directory_stamp', directory_stamp)
+        return changed
+
+    def add(self, name):
+        """adds or updates the given file of the music directory in the index"""
+        path = os.path.join(self.music_path, name)
+        file_stamp = stamp(path, regular_file=True)
+        if file_stamp is None:
+            return
+        info = read_track_info(path)
+        logger.debug('indexing track {}'.format(name))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (name, file_stamp[0], file_stamp[1], info['duration'], info['bitrate'],
+                                     info['title'], info['artist'], info['album']))
+
+    def remove(self, name):
+        """removes the given file from the index"""
+        logger.debug('removing track {} from index'.format(name))
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM tracks WHERE name = ?', (name,))
+
+    def tracks(self):
+        """returns the sorted names of all indexed files"""
+        return [row[0] for row in self.query('SELECT name FROM tracks ORDER BY name')]
+
+    def track_info(self, name):
+        """returns a dict with the stored information about the given track,
+        or None if it is not in the index"""
+        rows = self.query('SELECT name, mtime, size, duration, bitrate, title, artist, album '
+                          'FROM tracks WHERE name = ?', (name,))
+        if not rows:
+            return None
+        keys = ('name', 'mtime', 'size', 'duration', 'bitrate', 'title', 'artist', 'album')
+        return dict(zip(keys, rows[0]))
+
+    def random_track(self):
+        """returns the full path of a random mp3 file, or None if there is none"""
+        rows = self.query("SELECT name FROM tracks WHERE name LIKE '%.mp3' ORDER BY RANDOM() LIMIT 1")
+        if not rows:
+            return None
+        return os.path.join(self.music_path, rows[0][0])
+
+    def state(self, key):
+        rows = self.query('SELECT value FROM state WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def set_state(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+
+def stamp(path, regular_file=False):
+    """returns (mtime, size, inode) of the given path, or None if it does not
+    exist (or is no regular file, if requested)"""
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    if regular_file and not S_ISREG(file_stat.st_mode):
+        return None
+    return file_stat.st_mtime, file_stat.st_size, file_stat.st_ino
+
+
+def read_track_info(path):
+    """reads duration, bitrate and tags of the given audio file using mutagen.
+    All values are None if mutagen is not installed or can't read the file."""
+    info = dict.fromkeys(('duration', 'bitrate', 'title', 'artist', 'album'))
+    if mutagen is None:
+        return info
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        logger.debug('could not read tags of {}: {}'.format(path, e))
+        return info
+    if audio is None:
+        return info
+    info['duration'] = getattr(audio.info, 'length', None)
+    info['bitrate'] = getattr(audio.info, 'bitrate', None)
+    for key in ('title', 'artist', 'album'):
+        values = (audio.tags or {}).get(key)
+        if values:
+            info[key] = values[0]
+    return info
@@ -0,0 +1,118 @@
+import threading
+import math
+import time
+import logging
+
+from modules.clock import monotonic
+from modules.hardware import GPIO
+from modules.wakeup import Wakeup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Photocell(object):
+    """
+    samples the surrounding brightness in a background thread. The photocell
+    charges a capacitor, the brighter it is the faster. Instead of counting
+    loop iterations until the pin goes high, the time of the rising edge is
+    taken by an event detection callback, armed once per sample right after
+    the pin became an input. The default charge times match the range of the
+    old loop, which counted up to 400 iterations (about 2 ms) in the dark.
+    The charge times are mapped to a level of 0 - 15 on a log scale and
+    smoothed by an exponential moving average. The published level only
+    changes when the average moved more than hysteresis away from it, so the
+    display doesn't flicker between two levels.
+    """
+
+    def __init__(self, pin=20, interval=1.0, discharge_time=0.1, bright_time=0.0001, dark_time=0.002,
+                 alpha=0.3, hysteresis=0.7):
+        self.pin = pin
+        self.interval = interval
+        self.discharge_time = discharge_time
+        # charge times of the brightest (level 15) and the darkest (level 0) room
+        self.bright_time = bright_time
+        self.dark_time = dark_time
+        self.alpha = alpha
+        self.hysteresis = hysteresis
+        self.average = None
+        self.published = None
+        self.samples = 0
+        # monotonic time of the rising edge, set by the callback
+        self.edge_time = None
+        self.wakeup = Wakeup()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.run, name='photocell')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def level(self, default=15):
+        """the latest brightness level (0 - 15), default before the first sample"""
+        return self.published if self.published is not None else default
+
+    def run(self):
+        while self.running:
+            try:
+                charge_time = self.measure()
+            except Exception as e:
+                logger.warning('reading the photocell failed: {}'.format(e))
+                charge_time = None
+            if charge_time is not None:
+                self.update(self.scale(charge_time))
+            # the capacitor is discharged for discharge_time during the next measurement
+            time.sleep(max(self.interval - self.discharge_time, 0))
+
+    def measure(self):
+        """returns the time the capacitor needs to charge, or None if the
+        sample is unusable"""
+        # needs to be put low first, so the capacitor is empty
+        GPIO.setup(self.pin, GPIO.OUT)
+        GPIO.output(self.pin, GPIO.LOW)
+        time.sleep(self.discharge_time)
+
+        self.edge_time = None
+        start = monotonic()
+        GPIO.setup(self.pin, GPIO.IN)
+        GPIO.add_event_detect(self.pin, GPIO.RISING, callback=self.edge)
+        try:
+            if GPIO.input(self.pin) == GPIO.HIGH and self.edge_time is None:
+                # charged before the edge detection was armed
+                return self.bright_time
+            deadline = start + self.dark_time
+            while self.edge_time is None and monotonic() < deadline:
+                self.wakeup.wait(deadline - monotonic())
+        finally:
+            GPIO.remove_event_detect(self.pin)
+        if self.edge_time is None:
+            return self.dark_time
+        return self.edge_time - start
+
+    def edge(self, pin):
+        # runs on the callback thread of the gpio library
+        self.edge_time = monotonic()
+        self.wakeup.notify()
+
+    def scale(self, charge_time):
+        """charge time -> brightness level 0 (dark) - 15 (bright)"""
+        charge_time = min(max(charge_time, self.bright_time), self.dark_time)
+        position = math.log(self.dark_time / charge_time) / math.log(self.dark_time / self.bright_time)
+        return 15 * position
+
+    def update(self, level):
+        self.samples += 1
+        if self.average is None:
+            self.average = level
+        else:
+            self.average += self.alpha * (level - self.average)
+        if self.published is None or abs(self.average - self.published) >= self.hysteresis:
+            new_level = int(round(self.average))
+            if new_level != self.published:
+                logger.debug('surrounding brightness level changed from {} to {}'.format(self.published, new_level))
+                self.published = new_level
@@ -0,0 +1,317 @@
+import xml.etree.cElementTree as ET
+import hashlib
+import urllib2
+import json
+import threading
+import time
+import os
+import logging
+
+from email.utils import parsedate_tz, mktime_tz
+
+from modules.metrics import registry
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+
+class PodcastCache(object):
+    """
+    size-bounded disk cache for podcast feeds and episodes. Downloads are
+    revalidated with conditional requests (ETag / Last-Modified), so an
+    unchanged feed or episode costs a single 304. Interrupted downloads are
+    resumed with Range requests. The least recently used files are evicted
+    when the cache grows larger than max_size. Meant to prefetch the newest
+    episode some minutes before the alarm, so the alarm plays a local file.
+    """
+
+    def __init__(self, cache_path=project_path + '/podcasts', max_size=200 * 1024 * 1024,
+                 timeout=20, chunk_size=64 * 1024):
+        self.cache_path = cache_path
+        self.index_file = cache_path + '/index.json'
+        self.max_size = max_size
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # one download at a time, a second caller waits and gets the result
+        self.download_lock = threading.RLock()
+        # protects the index, only held for short lookups and updates, so the
+        # alarm doesn't wait for a running download
+        self.lock = threading.RLock()
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        self.index = self.read_index()
+
+    def prefetch(self, feed_url):
+        """downloads (or revalidates) the feed and its newest episode and
+        returns the path of the local episode file"""
+        with self.download_lock:
+            with self.lock:
+                previous = self.index.get(feed_url, {}).get('guid')
+            episode_url = self.episode_url(feed_url)
+            with self.lock:
+                episode = self.index.get(episode_url)
+                unchanged = (previous is not None and previous == self.index[feed_url].get('guid')
+                             and episode is not None and episode['complete']
+                             and os.path.isfile(self.path(episode_url)))
+            if unchanged:
+                # same episode as last time, no need to revalidate it
+                logger.debug('no new episode in {}'.format(feed_url))
+                episode_file = self.path(episode_url)
+            else:
+                episode_file = self.fetch(episode_url)
+            with self.lock:
+                feed_entry = self.index.get(feed_url)
+                if feed_entry is not None:
+                    feed_entry['episode'] = episode_url
+                    feed_entry['checked'] = time.time()
+                    self.write_index()
+            return episode_file
+
+    def cached_episode(self, feed_url, max_age=3600):
+        """returns the path of the newest episode of the feed if it was
+        completely downloaded by a prefetch within the last max_age seconds,
+        otherwise None. Doesn't wait for a running download."""
+        with self.lock:
+            feed_entry = self.index.get(feed_url, {})
+            if time.time() - feed_entry.get('checked', 0) > max_age:
+                registry.inc('cache_requests_total', cache='podcast', result='miss')
+                return None
+            episode_url = feed_entry.get('episode')
+            entry = self.index.get(episode_url)
+            if entry is None or not entry['complete'] or not os.path.isfile(self.path(episode_url)):
+                registry.inc('cache_requests_total', cache='podcast', result='miss')
+                return None
+            registry.inc('cache_requests_total', cache='podcast', result='hit')
+            entry['used'] = time.time()
+            self.write_index()
+            return self.path(episode_url)
+
+    def episode_url(self, feed_url):
+        """downloads (or revalidates) the feed and returns the url of its
+        newest episode. Its guid, publish date and duration are stored in
+        the index entry of the feed. While another download is running, the
+        episode url found by the last feed download is returned instead of
+        waiting for it."""
+        if not self.download_lock.acquire(False):
+            with self.lock:
+                newest = self.index.get(feed_url, {}).get('newest')
+            if newest is not None:
+                return newest
+            self.download_lock.acquire()
+        try:
+            feed_file = self.fetch(feed_url)
+            episode = newest_episode(feed_file)
+            if episode is None:
+                raise ValueError('no episode found in feed {}'.format(feed_url))
+            with self.lock:
+                self.index[feed_url].update((key, episode[key]) for key in ('guid', 'published', 'duration'))
+                self.index[feed_url]['newest'] = episode['url']
+                self.write_index()
+            return episode['url']
+        finally:
+            self.download_lock.release()
+
+    def add(self, url, source_file, etag=None, last_modified=None):
+        """moves a completely downloaded file (of the stream player) into
+        the cache"""
+        with self.lock:
+            os.rename(source_file, self.path(url))
+            self.index[url] = {'etag': etag, 'last_modified': last_modified, 'complete': True,
+                               'used': time.time(), 'size': os.path.getsize(self.path(url))}
+            self.write_index()
+            self.evict(keep=url)
+
+    def fetch(self, url):
+        """downloads url into the cache, unless the cached copy is still up
+        to date, and returns the path of the local file"""
+        with self.download_lock:
+            with self.lock:
+                entry = self.index.get(url)
+                path = self.path(url)
+                if entry is None or not os.path.isfile(path):
+                    entry = {'etag': None, 'last_modified': None, 'complete': False}
+                    if os.path.isfile(path):
+                        os.remove(path)
+                offset = os.path.getsize(path) if os.path.isfile(path) else 0
+
+            request = urllib2.Request(url)
+            if entry['complete']:
+                if entry['etag']:
+                    request.add_header('If-None-Match', entry['etag'])
+                if entry['last_modified']:
+                    request.add_header('If-Modified-Since', entry['last_modified'])
+            elif offset and (entry['etag'] or entry['last_modified']):
+                # resume, but only if the file on the server is still the same one
+                request.add_header('Range', 'bytes={}-'.format(offset))
+                request.add_header('If-Range', entry['etag'] or entry['last_modified'])
+            else:
+                offset = 0
+
+            start_time = time.time()
+            try:
+                response = urllib2.urlopen(request, timeout=self.timeout)
+            except urllib2.HTTPError as e:
+                if e.code == 304 and entry['complete']:
+                    logger.debug('cached copy of {} is up to date'.format(url))
+                    registry.inc('cache_requests_total', cache='http', result='hit')
+                    with self.lock:
+                        entry['used'] = time.time()
+                        self.index[url] = entry
+                        self.write_index()
+                    return path
+                if e.code == 416 and offset:
+                    # the partial file is no longer valid, start over
+                    with self.lock:
+                        os.remove(path)
+                        self.index.pop(url, None)
+                    return self.fetch(url)
+                raise
+
+            try:
+                if response.getcode() != 206:
+                    offset = 0
+                with self.lock:
+                    entry['etag'] = response.info().getheader('ETag')
+                    entry['last_modified'] = response.info().getheader('Last-Modified')
+                    entry['complete'] = False
+                    entry['used'] = time.time()
+                    self.index[url] = entry
+                    self.write_index()
+                received = self.download(response, path, offset)
+            finally:
+                response.close()
+
+            with self.lock:
+                entry['complete'] = True
+                entry['size'] = offset + received
+                self.write_index()
+            duration = time.time() - start_time
+            registry.inc('cache_requests_total', cache='http', result='miss')
+            registry.inc('download_bytes_total', received, source='podcast')
+            registry.observe('download_throughput_bytes_per_second', received / max(duration, 1e-3), source='podcast')
+            logger.info('downloaded {} ({} bytes{}) in {:.1f} sec'.format(
+                url, received, ', resumed at {}'.format(offset) if offset else '', duration))
+            self.evict(keep=url)
+            return path
+
+    def download(self, response, path, offset):
+        """writes the response body to path, appending if offset is not 0.
+        Returns the number of bytes received."""
+        received = 0
+        with open(path, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+        length = response.info().getheader('Content-Length')
+        if length is not None and received < int(length):
+            raise IOError('download of {} ended after {} of {} bytes'.format(path, received, length))
+        return received
+
+    def evict(self, keep=None):
+        """removes the least recently used files until the cache is not
+        larger than max_size"""
+        with self.lock:
+            entries = sorted((entry.get('used', 0), url) for url, entry in self.index.items() if url != keep)
+            total = sum(self.size(url) for url in self.index)
+            for _, url in entries:
+                if total <= self.max_size:
+                    break
+                total -= self.size(url)
+                logger.debug('evicting {} from the podcast cache'.format(url))
+                if os.path.isfile(self.path(url)):
+                    os.remove(self.path(url))
+                del self.index[url]
+            self.write_index()
+
+    def path(self, url):
+        """local file name of url: hash of the url plus its extension"""
+        extension = os.path.splitext(url.split('?')[0])[1][:8]
+        return '{}/{}{}'.format(self.cache_path, hashlib.sha1(url).hexdigest()[:20], extension)
+
+    def size(self, url):
+        try:
+            return os.path.getsize(self.path(url))
+        except OSError:
+            return 0
+
+    def read_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self):
+        temp_file = self.index_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(temp_file, self.index_file)
+
+
+def newest_episode(feed_file):
+    """returns the first episode with an enclosure of an rss or atom feed as
+    dict with url, guid, published (unix timestamp or None) and duration (in
+    seconds or None), or None if there is no such episode. The feed is parsed
+    incrementally: parsed items are cleared and parsing stops at the first
+    match, so memory use does not grow with the size of the feed."""
+    episode = None
+    for event, element in ET.iterparse(feed_file, events=('start', 'end')):
+        tag = local_name(element.tag)
+        if event == 'start':
+            if tag in ('item', 'entry'):
+                episode = {'url': None, 'guid': None, 'published': None, 'duration': None}
+            continue
+
+        if tag in ('item', 'entry'):
+            if episode['url']:
+                episode['guid'] = episode['guid'] or episode['url']
+                return episode
+            episode = None
+        elif episode is None:
+            pass
+        elif tag == 'enclosure':
+            episode['url'] = element.get('url')
+        elif tag == 'link' and element.get('rel') == 'enclosure':
+            episode['url'] = element.get('href')
+        elif tag in ('guid', 'id'):
+            episode['guid'] = (element.text or '').strip()
+        elif tag in ('pubDate', 'published', 'updated') and episode['published'] is None:
+            episode['published'] = parse_date(element.text)
+        elif tag == 'duration':
+            episode['duration'] = parse_duration(element.text)
+        # everything needed from the element was read, free its content
+        element.clear()
+    return None
+
+
+def newest_episode_url(feed_file):
+    """returns the url of the newest episode in the feed, or None"""
+    episode = newest_episode(feed_file)
+    return episode['url'] if episode is not None else None
+
+
+def local_name(tag):
+    """tag without namespace: '{http://www.w3.org/2005/Atom}entry' -> 'entry'"""
+    return tag.rpartition('}')[2]
+
+
+def parse_date(text):
+    """rfc 822 date of rss feeds -> unix timestamp, None if it can't be parsed"""
+    date = parsedate_tz((text or '').strip())
+    return mktime_tz(date) if date is not None else None
+
+
+def parse_duration(text):
+    """itunes duration ('3600', '59:30' or '1:00:00') -> seconds"""
+    try:
+        seconds = 0
+        for part in (text or '').strip().split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except ValueError:
+        return None
@@ -0,0 +1,183 @@
+import datetime
+import heapq
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# rrule day names in the order of datetime.weekday()
+RRULE_DAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+# how many days to look ahead for the next occurrence (skip dates included)
+MAX_LOOKAHEAD_DAYS = 2 * 366
+
+
+class Alarm(object):
+    """
+    one alarm with its own time, recurrence and content. The recurrence is
+    either given as days in the format of data.xml ('1,2,3' with 0 = sunday,
+    like time.strftime('%w')) or as a subset of an iCalendar RRULE:
+    FREQ=DAILY|WEEKLY, INTERVAL, BYDAY, DTSTART and UNTIL, for example
+    'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,FR;DTSTART=20261019'. An rrule without
+    FREQ, like 'DTSTART=20261224', rings only once on that date.
+    """
+
+    def __init__(self, alarm_id, alarm_time, days=None, rrule=None, skip_dates=(), content=None, active=True):
+        self.alarm_id = alarm_id
+        self.alarm_time = alarm_time
+        self.hours, self.minutes = parse_time(alarm_time)
+        self.content = content
+        self.active = active
+        self.skip_dates = set(parse_date(date) for date in skip_dates if date)
+        self.frequency = None
+        self.interval = 1
+        self.weekdays = None
+        self.start = None
+        self.until = None
+        if rrule:
+            self.parse_rrule(rrule)
+        elif days is not None:
+            self.frequency = 'WEEKLY'
+            self.weekdays = set(parse_day(day) for day in days.split(',') if day.strip())
+
+    def parse_rrule(self, rrule):
+        for part in rrule.split(';'):
+            key, _, value = part.partition('=')
+            key = key.strip().upper()
+            value = value.strip().upper()
+            if key == 'FREQ':
+                if value not in ('DAILY', 'WEEKLY'):
+                    raise ValueError('unsupported FREQ: {}'.format(value))
+                self.frequency = value
+            elif key == 'INTERVAL':
+                self.interval = int(value)
+                if self.interval < 1:
+                    raise ValueError('INTERVAL has to be positive')
+            elif key == 'BYDAY':
+                self.weekdays = set(RRULE_DAYS.index(day) for day in value.split(','))
+            elif key == 'DTSTART':
+                self.start = parse_date(value)
+            elif key == 'UNTIL':
+                self.until = parse_date(value[:8])
+            elif key:
+                raise ValueError('unsupported rrule part: {}'.format(part))
+        if self.frequency == 'WEEKLY' and self.weekdays is None:
+            self.weekdays = set([(self.start or datetime.date.today()).weekday()])
+
+    def occurs_on(self, day):
+        """checks if the alarm rings on the given date"""
+        if day in self.skip_dates:
+            return False
+        if self.start is not None and day < self.start:
+            return False
+        if self.until is not None and day > self.until:
+            return False
+        if self.frequency is None:
+            return day == self.start
+        if self.weekdays is not None and day.weekday() not in self.weekdays:
+            return False
+        if self.interval > 1:
+            start = self.start or datetime.date(1970, 1, 5)
+            if self.frequency == 'DAILY':
+                return (day - start).days % self.interval == 0
+            # weekly: count whole weeks, starting on the monday of the start week
+            week_start = start - datetime.timedelta(days=start.weekday())
+            return ((day - week_start).days // 7) % self.interval == 0
+        return True
+
+    def next_occurrence(self, after):
+        """returns the unix timestamp of the first alarm after the given
+        timestamp, or None if there is none. Works in local time, so the alarm
+        stays at its time of day when daylight saving time starts or ends."""
+        if not self.active or self.weekdays == set():
+            return None
+        date = datetime.date.fromtimestamp(after)
+        if self.start is not None and self.start > date:
+            date = self.start
+        for day_offset in range(MAX_LOOKAHEAD_DAYS):
+            day = date + datetime.timedelta(days=day_offset)
+            if self.until is not None and day > self.until:
+                return None
+            if not self.occurs_on(day):
+                continue
+            timestamp = time.mktime((day.year, day.month, day.day, self.hours, self.minutes, 0, 0, 0, -1))
+            if timestamp > after:
+                return timestamp
+            if self.frequency is None:
+                return None
+        return None
+
+    def __repr__(self):
+        return 'Alarm({!r}, {!r})'.format(self.alarm_id, self.alarm_time)
+
+
+class AlarmIndex(object):
+    """
+    answers "which alarm rings next after t" for many alarms. The next
+    occurrence of every alarm is kept in a heap, so a query costs O(log n)
+    for every alarm which rang in between (amortized O(log n) for the
+    usually increasing query times). Querying an earlier time than before
+    rebuilds the heap. Alarms are kept by position, so two alarms with the
+    same id both ring.
+    """
+
+    def __init__(self, alarms):
+        self.alarms = list(alarms)
+        self.lock = threading.Lock()
+        self.rebuild(time.time())
+
+    def rebuild(self, after):
+        self.after = after
+        self.heap = []
+        for position, alarm in enumerate(self.alarms):
+            occurrence = alarm.next_occurrence(after)
+            if occurrence is not None:
+                self.heap.append((occurrence, position))
+        heapq.heapify(self.heap)
+
+    def next_after(self, after):
+        """returns (timestamp, alarm) of the next alarm after the given
+        timestamp, or (None, None) if no alarm is set"""
+        with self.lock:
+            if after < self.after:
+                self.rebuild(after)
+            self.after = after
+            while self.heap and self.heap[0][0] <= after:
+                _, position = heapq.heappop(self.heap)
+                occurrence = self.alarms[position].next_occurrence(after)
+                if occurrence is not None:
+                    heapq.heappush(self.heap, (occurrence, position))
+            if not self.heap:
+                return None, None
+            occurrence, position = self.heap[0]
+            return occurrence, self.alarms[position]
+
+
+def default_alarm_id(number):
+    """id of the number-th <alarm> element without id attribute, can't be
+    mistaken for an id the user gave"""
+    return 'alarm-{}'.format(number)
+
+
+def parse_time(alarm_time):
+    """'HH:MM' -> (hours, minutes)"""
+    hours, _, minutes = alarm_time.partition(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError('invalid alarm time: {}'.format(alarm_time))
+    return hours, minutes
+
+
+def parse_day(day):
+    """day number of data.xml (0 = sunday) -> datetime.weekday()"""
+    if day.strip() not in ('0', '1', '2', '3', '4', '5', '6'):
+        raise ValueError('invalid day: {}'.format(day))
+    return (int(day) + 6) % 7
+
+
+def parse_date(date):
+    """'YYYYMMDD' or 'YYYY-MM-DD' -> datetime.date"""
+    date = date.strip().replace('-', '')
+    return datetime.date(int(date[:4]), int(date[4:6]), int(date[6:8]))
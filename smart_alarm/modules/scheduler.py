@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+from modules.clock import monotonic
+from modules.wakeup import Wakeup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    event scheduler based on a priority queue of monotonic deadlines. run()
+    sleeps exactly until the next event is due instead of polling. It waits
+    on a pipe, since python 2 implements timed waits of threading objects by
+    polling. Events which are bound to a wall clock time (like the alarm)
+    remember it, so they are moved when the system clock jumps (ntp sync,
+    manual change).
+    """
+
+    def __init__(self, jump_threshold=2.0):
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # wakes up run() when the queue changed
+        self.wakeup = Wakeup()
+        self.running = False
+        # difference between wall clock and monotonic clock, changes on jumps
+        self.jump_threshold = jump_threshold
+        self.clock_offset = time.time() - monotonic()
+        # optional function, called after the clock jumped
+        self.on_clock_jump = None
+
+    def at(self, deadline, name, callback, *args):
+        """schedules callback(*args) at the given monotonic deadline"""
+        self.push([deadline, next(self.counter), name, None, callback, args])
+
+    def after(self, delay, name, callback, *args):
+        """schedules callback(*args) in delay seconds"""
+        self.at(monotonic() + delay, name, callback, *args)
+
+    def at_wall_time(self, timestamp, name, callback, *args):
+        """schedules callback(*args) at the given unix timestamp"""
+        deadline = timestamp - (time.time() - monotonic())
+        self.push([deadline, next(self.counter), name, timestamp, callback, args])
+
+    def cancel(self, name):
+        """removes all events with the given name from the queue"""
+        with self.lock:
+            self.queue = [event for event in self.queue if event[2] != name]
+            heapq.heapify(self.queue)
+        self.notify()
+
+    def next_event(self, name):
+        """returns the deadline of the next event with the given name, or None"""
+        with self.lock:
+            deadlines = [event[0] for event in self.queue if event[2] == name]
+        return min(deadlines) if deadlines else None
+
+    def check_clock(self):
+        """detects jumps of the wall clock and moves all wall clock events
+        accordingly. Returns True if the clock jumped."""
+        offset = time.time() - monotonic()
+        if abs(offset - self.clock_offset) < self.jump_threshold:
+            return False
+        logger.warning('system clock jumped by {:.1f} sec, rescheduling events'.format(offset - self.clock_offset))
+        self.clock_offset = offset
+        with self.lock:
+            for event in self.queue:
+                if event[3] is not None:
+                    event[0] = event[3] - offset
+            heapq.heapify(self.queue)
+        if self.on_clock_jump is not None:
+            self.call('on_clock_jump', self.on_clock_jump)
+        return True
+
+    def run(self):
+        """runs the due events until stop() is called"""
+        self.running = True
+        while self.running:
+            self.check_clock()
+            event = None
+            with self.lock:
+                timeout = self.queue[0][0] - monotonic() if self.queue else None
+                if timeout is not None and timeout <= 0:
+                    event = heapq.heappop(self.queue)
+            if event is None:
+                self.wait(timeout)
+                continue
+            deadline, _, name, _, callback, args = event
+            self.call(name, callback, *args)
+
+    def call(self, name, callback, *args):
+        """runs an event. A failing callback is logged, it must not end
+        the scheduler and with it every following event."""
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('scheduled event {} failed'.format(name))
+
+    def stop(self):
+        self.running = False
+        self.notify()
+
+    def wait(self, timeout):
+        """sleeps until the timeout passed or notify() is called"""
+        self.wakeup.wait(timeout)
+
+    def notify(self):
+        self.wakeup.notify()
+
+    def push(self, event):
+        with self.lock:
+            heapq.heappush(self.queue, event)
+        self.notify()
@@ -0,0 +1,438 @@
+"""simulated hardware, so the daemon runs on a normal linux box:
+
+    smart_alarm_simulate=1 smart_alarm_path=... python smart_alarm/smart_alarm
+
+smart_alarm_simulate_speed makes audio and speech play that many times
+faster than real time. smart_alarm_simulate_script names a json file of
+timed inputs, seconds after the start:
+
+    [{"at": 5, "press": 24, "duration": 0.2},
+     {"at": 60, "charge_time": 0.0015, "pin": 20}]
+"""
+import threading
+import json
+import time
+import os
+import logging
+
+from collections import deque
+
+from modules.clock import monotonic
+from modules.audio_engine import NullSink
+from modules.led_engine import FakeSpiSink
+
+
+logger = logging.getLogger(__name__)
+
+# audio and speech play this many times faster than real time
+speed = float(os.environ.get('smart_alarm_simulate_speed', 1.0))
+
+# seconds of audio per byte of a 128 kbit/s mp3 and per character of speech
+MP3_SECONDS_PER_BYTE = 8.0 / 128000
+SPEECH_SECONDS_PER_CHARACTER = 0.07
+
+# segment masks of the characters, copied from
+# Adafruit_LED_Backpack.AlphaNum4 (MIT license), which isn't installed off
+# the pi
+DIGIT_VALUES = {
+    ' ': 0b0000000000000000,
+    '!': 0b0000000000000110,
+    '"': 0b0000001000100000,
+    '#': 0b0001001011001110,
+    '$': 0b0001001011101101,
+    '%': 0b0000110000100100,
+    '&': 0b0010001101011101,
+    '\'': 0b0000010000000000,
+    '(': 0b0010010000000000,
+    ')': 0b0000100100000000,
+    '*': 0b0011111111000000,
+    '+': 0b0001001011000000,
+    ',': 0b0000100000000000,
+    '-': 0b0000000011000000,
+    '.': 0b0000000000000000,
+    '/': 0b0000110000000000,
+    '0': 0b0000110000111111,
+    '1': 0b0000000000000110,
+    '2': 0b0000000011011011,
+    '3': 0b0000000010001111,
+    '4': 0b0000000011100110,
+    '5': 0b0010000001101001,
+    '6': 0b0000000011111101,
+    '7': 0b0000000000000111,
+    '8': 0b0000000011111111,
+    '9': 0b0000000011101111,
+    ':': 0b0001001000000000,
+    ';': 0b0000101000000000,
+    '<': 0b0010010000000000,
+    '=': 0b0000000011001000,
+    '>': 0b0000100100000000,
+    '?': 0b0001000010000011,
+    '@': 0b0000001010111011,
+    'A': 0b0000000011110111,
+    'B': 0b0001001010001111,
+    'C': 0b0000000000111001,
+    'D': 0b0001001000001111,
+    'E': 0b0000000011111001,
+    'F': 0b0000000001110001,
+    'G': 0b0000000010111101,
+    'H': 0b0000000011110110,
+    'I': 0b0001001000000000,
+    'J': 0b0000000000011110,
+    'K': 0b0010010001110000,
+    'L': 0b0000000000111000,
+    'M': 0b0000010100110110,
+    'N': 0b0010000100110110,
+    'O': 0b0000000000111111,
+    'P': 0b0000000011110011,
+    'Q': 0b0010000000111111,
+    'R': 0b0010000011110011,
+    'S': 0b0000000011101101,
+    'T': 0b0001001000000001,
+    'U': 0b0000000000111110,
+    'V': 0b0000110000110000,
+    'W': 0b0010100000110110,
+    'X': 0b0010110100000000,
+    'Y': 0b0001010100000000,
+    'Z': 0b0000110000001001,
+    '[': 0b0000000000111001,
+    '\\': 0b0010000100000000,
+    ']': 0b0000000000001111,
+    '^': 0b0000110000000011,
+    '_': 0b0000000000001000,
+    '`': 0b0000000100000000,
+    'a': 0b0001000001011000,
+    'b': 0b0010000001111000,
+    'c': 0b0000000011011000,
+    'd': 0b0000100010001110,
+    'e': 0b0000100001011000,
+    'f': 0b0000000001110001,
+    'g': 0b0000010010001110,
+    'h': 0b0001000001110000,
+    'i': 0b0001000000000000,
+    'j': 0b0000000000001110,
+    'k': 0b0011011000000000,
+    'l': 0b0000000000110000,
+    'm': 0b0001000011010100,
+    'n': 0b0001000001010000,
+    'o': 0b0000000011011100,
+    'p': 0b0000000101110000,
+    'q': 0b0000010010000110,
+    'r': 0b0000000001010000,
+    's': 0b0010000010001000,
+    't': 0b0000000001111000,
+    'u': 0b0000000000011100,
+    'v': 0b0010000000000100,
+    'w': 0b0010100000010100,
+    'x': 0b0010100011000000,
+    'y': 0b0010000000001100,
+    'z': 0b0000100001001000,
+    '{': 0b0000100101001001,
+    '|': 0b0001001000000000,
+    '}': 0b0010010010001001,
+    '~': 0b0000010100100000,
+}
+
+# characters by segment mask, for reading the display back. Where characters
+# share a mask ('1' and '!'), letters and digits win
+CHARACTERS = {}
+for character, mask in sorted(DIGIT_VALUES.items(), key=lambda item: (not item[0].isalnum(), item[0])):
+    CHARACTERS.setdefault(mask, character)
+# the decimal point of a digit
+DECIMAL_POINT = 1 << 14
+
+
+class SimulatedGPIO(object):
+    """
+    stands in for the RPi.GPIO module. Inputs are low until a button press
+    is simulated, outputs are recorded. A pin which was set low and then
+    becomes an input (the photocell) goes high after the configured charge
+    time, like the capacitor would.
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, default_charge_time=0.0005):
+        self.levels = {}
+        self.modes = {}
+        # (monotonic time, pin, value) of the recent outputs
+        self.outputs = deque(maxlen=1000)
+        self.callbacks = {}
+        # seconds, or function returning seconds, per photocell pin
+        self.charge_times = {}
+        self.default_charge_time = default_charge_time
+        # marks the pins with a charging capacitor
+        self.charging = {}
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        with self.lock:
+            discharged = self.modes.get(pin) == self.OUT and self.levels.get(pin) == self.LOW
+            self.modes[pin] = mode
+            self.levels.setdefault(pin, self.LOW)
+            self.stop_charging(pin)
+        if initial is not None:
+            self.output(pin, initial)
+        if mode == self.IN and discharged:
+            self.charge(pin)
+
+    def charge(self, pin):
+        """raises the pin after its charge time, unless it is set up or set
+        low again before"""
+        charge_time = self.charge_times.get(pin, self.default_charge_time)
+        if callable(charge_time):
+            charge_time = charge_time()
+        charging = object()
+        with self.lock:
+            self.charging[pin] = charging
+        thread = threading.Thread(target=self.charged, args=(pin, charging, charge_time), name='photocell charge')
+        thread.daemon = True
+        thread.start()
+
+    def charged(self, pin, charging, charge_time):
+        time.sleep(charge_time)
+        with self.lock:
+            if self.charging.get(pin) is not charging:
+                return
+            del self.charging[pin]
+            self.levels[pin] = self.HIGH
+            edge, callback = self.callbacks.get(pin, (None, None))
+        # called right away, the edge time is what is measured
+        if callback is not None and edge in (self.RISING, self.BOTH):
+            callback(pin)
+
+    def stop_charging(self, pin):
+        self.charging.pop(pin, None)
+
+    def output(self, pin, value):
+        with self.lock:
+            self.stop_charging(pin)
+            self.levels[pin] = self.HIGH if value else self.LOW
+            self.outputs.append((monotonic(), pin, self.levels[pin]))
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        with self.lock:
+            self.callbacks.clear()
+
+    def set_input(self, pin, value):
+        """changes the level of an input pin and calls its edge callback"""
+        with self.lock:
+            old, self.levels[pin] = self.levels.get(pin, self.LOW), self.HIGH if value else self.LOW
+            edge, callback = self.callbacks.get(pin, (None, None))
+            new = self.levels[pin]
+        if callback is None or old == new:
+            return
+        if edge == self.BOTH or (edge == self.RISING) == bool(new):
+            thread = threading.Thread(target=callback, args=(pin,), name='gpio callback')
+            thread.daemon = True
+            thread.start()
+
+    def press(self, pin, duration=0.2):
+        """presses the button on pin for duration seconds, without blocking"""
+        self.set_input(pin, self.HIGH)
+        timer = threading.Timer(duration, self.set_input, args=(pin, self.LOW))
+        timer.daemon = True
+        timer.start()
+
+    def set_charge_time(self, pin, charge_time):
+        """seconds the photocell capacitor on pin needs to charge, or a
+        function returning them, called for every sample"""
+        self.charge_times[pin] = charge_time
+
+    def run_script(self, path):
+        """plays the timed button presses and charge times of a json file
+        from a background thread"""
+        with open(path) as script_file:
+            steps = sorted(json.load(script_file), key=lambda step: step['at'])
+        thread = threading.Thread(target=self.play_script, args=(steps,), name='gpio script')
+        thread.daemon = True
+        thread.start()
+
+    def play_script(self, steps):
+        start = monotonic()
+        for step in steps:
+            delay = start + step['at'] - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            logger.debug('simulating {}'.format(step))
+            if 'press' in step:
+                self.press(step['press'], step.get('duration', 0.2))
+            if 'charge_time' in step:
+                self.set_charge_time(step.get('pin', 20), step['charge_time'])
+
+
+class I2CRecorder(object):
+    """records the writes of the display to the i2c bus and keeps the
+    display ram they changed"""
+
+    def __init__(self, on_change=None):
+        self.writes = self.bytes = 0
+        self.ram = bytearray(16)
+        self.on_change = on_change
+
+    def writeList(self, register, data):
+        self.writes += 1
+        self.bytes += len(data) + 1
+        self.ram[register:register + len(data)] = bytearray(data)
+        if self.on_change is not None:
+            self.on_change(self.ram)
+
+    def write8(self, register, value):
+        self.writes += 1
+        self.bytes += 2
+
+    def writeRaw8(self, value):
+        self.writes += 1
+        self.bytes += 1
+
+
+class RecordingDisplay(object):
+    """
+    stands in for Adafruit_LED_Backpack.AlphaNum4: keeps the segment buffer
+    and brightness, and records the texts shown, read back from the
+    display ram
+    """
+
+    def __init__(self):
+        self.buffer = bytearray(16)
+        self._device = I2CRecorder(on_change=self.displayed)
+        self.brightness = 15
+        # (monotonic time, text) of the recent texts
+        self.texts = deque(maxlen=100)
+
+    def displayed(self, ram):
+        text = read_text(ram)
+        if not self.texts or self.texts[-1][1] != text:
+            self.texts.append((monotonic(), text))
+
+    def begin(self):
+        pass
+
+    def clear(self):
+        for i in range(len(self.buffer)):
+            self.buffer[i] = 0
+
+    def set_brightness(self, brightness):
+        self.brightness = brightness
+
+    def set_digit_raw(self, pos, bitmask):
+        if 0 <= pos <= 3:
+            self.buffer[pos * 2] = bitmask & 0xFF
+            self.buffer[pos * 2 + 1] = (bitmask >> 8) & 0xFF
+
+    def set_decimal(self, pos, decimal):
+        if 0 <= pos <= 3:
+            if decimal:
+                self.buffer[pos * 2 + 1] |= 1 << 6
+            else:
+                self.buffer[pos * 2 + 1] &= ~(1 << 6) & 0xFF
+
+    def set_led(self, led, value):
+        if 0 <= led <= 127:
+            if value:
+                self.buffer[led // 8] |= 1 << (led % 8)
+            else:
+                self.buffer[led // 8] &= ~(1 << (led % 8)) & 0xFF
+
+    def print_str(self, value, justify_right=True):
+        position = 4 - len(value) if justify_right else 0
+        for i, character in enumerate(value):
+            self.set_digit_raw(position + i, DIGIT_VALUES.get(str(character), 0))
+
+    def print_number_str(self, value, justify_right=True):
+        """like print_str, but a period is the decimal point of the digit
+        before it"""
+        length = len(value.replace('.', ''))
+        if length > 4:
+            self.print_str('----')
+            return
+        position = 4 - length if justify_right else 0
+        for character in value:
+            if character == '.':
+                self.set_decimal(position - 1, True)
+            else:
+                self.set_digit_raw(position, DIGIT_VALUES.get(str(character), 0))
+                position += 1
+
+
+def read_text(ram):
+    """the 4 characters shown by the segment masks in the display ram,
+    '?' for masks which are no character"""
+    text = ''
+    for position in range(4):
+        mask = ram[position * 2] | ram[position * 2 + 1] << 8
+        text += CHARACTERS.get(mask & ~DECIMAL_POINT, '?')
+        if mask & DECIMAL_POINT:
+            text += '.'
+    return text
+
+
+class RecordingStrip(FakeSpiSink):
+    """led sink keeping the recent frames, written as fast as the real spi bus"""
+
+    def __init__(self, speed_hz=8000000):
+        super(RecordingStrip, self).__init__(speed_hz)
+        self.recent = deque(maxlen=100)
+
+    def write(self, data):
+        super(RecordingStrip, self).write(data)
+        self.recent.append(data)
+
+
+class NullSpeech(object):
+    """speech cache without espeak. The phrases are 'rendered' to pseudo
+    files, which the null audio sink plays as long as saying them would
+    take."""
+
+    prefix = 'speech:'
+
+    def path(self, text, rate=None):
+        return self.prefix + text
+
+    cached = render = path
+
+
+def audio_duration(path):
+    """seconds the null sink plays path, in simulated time"""
+    if path.startswith(NullSpeech.prefix):
+        seconds = len(path) * SPEECH_SECONDS_PER_CHARACTER
+    else:
+        try:
+            seconds = os.path.getsize(path) * MP3_SECONDS_PER_BYTE
+        except OSError:
+            seconds = 1.0
+    return seconds / speed
+
+
+def audio_sink():
+    return NullSink(durations=audio_duration)
+
+
+GPIO = SimulatedGPIO()
@@ -1,11 +1,12 @@
-import pygame
-import pyttsx
-import time
-from random import randint
 import os
-import RPi.GPIO as GPIO
 import logging
 
+from modules import hardware
+from modules.hardware import GPIO
+from modules.music_library import MusicLibrary
+from modules.streaming import StreamPlayer
+from modules.audio_engine import AudioEngine, AudioItem
+
 
 # set button input pin
 button_input_pin = 24
@@ -19,25 +20,59 @@ GPIO.setmode(GPIO.BCM)
 # set pin to output
 GPIO.setup(amp_switch_pin, GPIO.OUT)
 
+# volume of the wake-up music: from 30% to full volume within a minute
+wake_up_ramp = (0.3, 1.0, 60)
+
 # read environmental variable for project path
 project_path = os.environ['smart_alarm_path']
 logger = logging.getLogger(__name__)
 
 
 class Sound(object):
-    """sound class manages smart alarm audio"""
+    """sound class manages smart alarm audio. Everything is played by one
+    audio engine thread, which owns the mixer and the amplifier"""
 
-    def __init__(self):
+    def __init__(self, sink=None):
         """initialize variables"""
         # write to error.log file
         logger.info('sound-module initialized')
-        self.sound_active = False
-        self.stop_sound = False
+        self.library = MusicLibrary()
+        self.stream_player = StreamPlayer(hardware.stream_decoder())
+        self.speech_rate = 125
+        self.speech = hardware.speech_cache(self.speech_rate)
+        # live speech engine, used if a phrase can't be rendered. Created
+        # once, since initializing it takes long
+        self.tts_engine = None
+        # timing record of the running alarm, see modules/alarm_timing.py
+        self.timing = None
+        self.audio = AudioEngine(sink or hardware.audio_sink(), amp=self.toggle_amp_pin).start()
+
+    @property
+    def sound_active(self):
+        return self.audio.busy()
 
     def stopping_sound(self):
         """stops alarm when button is pressed"""
         logger.warning('current sound play is being stopped')
-        self.stop_sound = True
+        self.audio.stop()
+
+    def mark(self, phase):
+        """records the phase in the timing of the running alarm"""
+        timing = self.timing
+        if timing is not None:
+            timing.mark(phase)
+
+    def marker(self, *phases):
+        """returns a callback recording the phases in the timing of the alarm
+        running now. Audio callbacks run later, maybe when the next alarm
+        has started already, so the record is taken when they are created."""
+        timing = self.timing
+
+        def mark():
+            if timing is not None:
+                for phase in phases:
+                    timing.mark(phase)
+        return mark
 
     def toggle_amp_pin(self, toggle):
         # set pwm audio pin one or zero, depending on the current state
@@ -46,67 +81,74 @@ class Sound(object):
             GPIO.output(amp_switch_pin, 0)
         elif toggle == 1:
             GPIO.output(amp_switch_pin, 1)
+            self.mark('amp on')
         else:
             raise TypeError("got wrong value for toggle variable, should be 1 or 0.")
 
-    def play_mp3_file(self, mp3_file, force=False):
-        if self.sound_active:
-            if force:
-                self.stopping_sound()
-            else:
-                while self.sound_active:
-                    logging.debug("waiting until sound play is finish")
-                    time.sleep(1)
-        logger.warning("sound play done - now playing next")
-
-        self.sound_active = True
-        # set output high in order to turn on amplifier
-        self.toggle_amp_pin(1)
-        time.sleep(0.3)
-        pygame.mixer.init()
-        pygame.mixer.music.load(mp3_file)
+    def play(self, item, force=False, wait=True):
+        """queues the audio item, force stops everything else first. Blocks
+        until the item was played if wait is True."""
+        if force:
+            self.audio.stop()
+        self.audio.enqueue(item)
+        if wait:
+            item.wait()
+        return item
+
+    def play_mp3_file(self, mp3_file, force=False, wait=True, ramp=None, on_start=None):
         logger.debug("now playing file: {}".format(mp3_file))
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            time.sleep(0.1)
-            if self.stop_sound:
-                pygame.mixer.music.stop()
-                pygame.mixer.quit()
-                logger.debug('mp3 alarm turned off via button pressed')
-                break
-            else:
-                continue
-        time.sleep(0.5)
-        # set output low in order to turn off amplifier
-        self.toggle_amp_pin(0)
-        pygame.mixer.quit()
-        self.sound_active = False
-        self.stop_sound = False
-
-    def say(self, text, force=False):
+        return self.play(AudioItem(mp3_file, ramp=ramp, on_start=on_start), force, wait)
+
+    def play_stream(self, url, save_file=None, force=False):
+        """plays an mp3 file while it is still downloading and saves it to
+        save_file. Returns the playback statistics of the stream player."""
+        logger.debug("now streaming: {}".format(url))
+        stats = {}
+
+        def stream(token):
+            stats.update(self.stream_player.play(url, save_file, cancel=token, on_start=item.start))
+
+        item = AudioItem(function=stream, name=url, backend='stream',
+                         on_start=self.marker('first audio', 'content start'))
+        self.play(item, force)
+        logger.info('time to first audio {}, {} buffer underruns'.format(
+            stats.get('time_to_first_audio'), stats.get('underruns')))
+        return stats
+
+    def say(self, text, force=False, wait=True):
         """synthesizes the given text to speech"""
-        if self.sound_active:
-            if force:
-                self.stopping_sound()
-            else:
-                while self.sound_active:
-                    logging.debug("waiting until sound play is finish")
-                    time.sleep(1)
-        logger.warning("sound play done - now playing next")
-
-        self.sound_active = True
-        # set output high in order to turn on amplifier
-        self.toggle_amp_pin(1)
-        time.sleep(0.3)
-        engine = pyttsx.init()
-        engine.setProperty('rate', 125)
-        # remove "pass" and uncomment next line in order to enable this function
-        engine.say(text)
-        engine.runAndWait()
-        time.sleep(0.2)
-        # set output low in order to turn off amplifier
-        self.toggle_amp_pin(0)
-        self.sound_active = False
+        on_start = self.marker('tts start', 'first audio')
+        on_finish = self.marker('tts end')
+        # espeak renders while the amp warms up
+        self.audio.warm_up()
+        wav_file = self.speech.render(text)
+        if wav_file is not None:
+            return self.play(AudioItem(wav_file, name=text, backend='tts', on_start=on_start, on_finish=on_finish),
+                             force, wait)
+
+        def speak(token):
+            engine = self.speech_engine()
+            token.add_callback(engine.stop)
+            item.start()
+            engine.say(text)
+            engine.runAndWait()
+            token.remove_callback(engine.stop)
+
+        item = AudioItem(function=speak, name=text, backend='tts', on_start=on_start, on_finish=on_finish)
+        return self.play(item, force, wait)
+
+    def speech_engine(self):
+        if self.tts_engine is None:
+            import pyttsx
+            self.tts_engine = pyttsx.init()
+            self.tts_engine.setProperty('rate', self.speech_rate)
+        return self.tts_engine
+
+    def prerender(self, *phrases):
+        """renders phrases into the speech cache, so saying them later
+        starts without delay"""
+        for text in phrases:
+            self.speech.render(text)
 
     def adjust_volume(self, value):
         """adjusts the audio volume by the given value (0-100%)"""
@@ -115,48 +157,29 @@ class Sound(object):
         os.system(volume_command)
 
     def play_wakeup_music(self):
-        """find all mp3 files in the folder /home/pi/music
-        and play one of them at random"""
-        list_of_music_files = []
-        for track in os.listdir(project_path + '/music'):
-            if track.endswith(".mp3"):
-                list_of_music_files.append(str(project_path + '/music/' + str(track)))
+        """pick a random mp3 file from the music library index and play it,
+        slowly getting louder"""
+        random_track = self.library.random_track()
+        if random_track is None:
+            logger.warning('no mp3 files found in the music library')
+            return
 
-        # figure out random track of the found mp3 files
-        random_track = randint(0, len(list_of_music_files)-1)
-
-        self.play_mp3_file(list_of_music_files[random_track])
+        self.mark('content ready')
+        self.play_mp3_file(random_track, ramp=wake_up_ramp, on_start=self.marker('first audio', 'content start'))
 
     def play_online_stream(self, force=False):
         """plays online radio using mpc. Press button to stop. Edit mpc playlist by:
         'mpc add filename', 'mpc playlist', 'mpc clear', 'mpc play', 'mpc stop'."""
-        if self.sound_active:
-            if force:
-                self.stopping_sound()
-            else:
-                while self.sound_active:
-                    logging.debug("waiting until sound play is finish")
-                    time.sleep(1)
-        logger.warning("sound play done - now playing next")
-
-        self.sound_active = True
-
-        logger.debug('now playing internet radio')
-        # set output high in order to turn on amplifier
-        self.toggle_amp_pin(1)
-        time.sleep(0.3)
-        os.system('mpc play')
-
-        while True:
-            if self.stop_sound is False:
-                pass
-            else:
-                break
-
-        os.system('mpc stop')
-        time.sleep(0.5)
-        # set output low in order to turn off amplifier
-        self.toggle_amp_pin(0)
-        logger.debug('internet radio alarm turned off')
-        self.sound_active = False
-        self.stop_sound = False
+
+        def online_stream(token):
+            logger.debug('now playing internet radio')
+            os.system('mpc play')
+            item.start()
+            # sleeps without using the cpu until the button is pressed
+            token.wait()
+            os.system('mpc stop')
+            logger.debug('internet radio alarm turned off')
+
+        item = AudioItem(function=online_stream, name='online stream', backend='radio',
+                         on_start=self.marker('first audio', 'content start'))
+        self.play(item, force)
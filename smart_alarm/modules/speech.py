@@ -0,0 +1,85 @@
+import subprocess
+import hashlib
+import threading
+import os
+import logging
+
+from modules.metrics import registry
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+
+class SpeechCache(object):
+    """
+    renders phrases to wav files with espeak and keeps them on disk, keyed
+    by the hash of text, rate and voice. A cached phrase starts playing
+    without running the speech synthesis again. The least recently used
+    files are deleted when there are more than max_files.
+    """
+
+    def __init__(self, cache_path=project_path + '/speech', max_files=200, rate=125, voice=None,
+                 command='espeak'):
+        self.cache_path = cache_path
+        self.max_files = max_files
+        self.rate = rate
+        self.voice = voice
+        self.command = command
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+
+    def path(self, text, rate=None):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        key = u'{}\0{}\0{}'.format(rate or self.rate, self.voice, text).encode('utf-8')
+        return '{}/{}.wav'.format(self.cache_path, hashlib.sha1(key).hexdigest())
+
+    def cached(self, text, rate=None):
+        """returns the wav file of the phrase if it was rendered before"""
+        path = self.path(text, rate)
+        try:
+            # the mtime marks the last use for the lru eviction
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def render(self, text, rate=None):
+        """returns the wav file of the phrase, rendering it if necessary.
+        Returns None if the phrase can't be rendered."""
+        path = self.cached(text, rate)
+        if path is not None:
+            registry.inc('cache_requests_total', cache='speech', result='hit')
+            return path
+        registry.inc('cache_requests_total', cache='speech', result='miss')
+
+        path = self.path(text, rate)
+        temp_file = path + '.tmp'
+        command = [self.command, '-s', str(rate or self.rate), '-w', temp_file]
+        if self.voice:
+            command += ['-v', self.voice]
+        try:
+            with self.lock:
+                subprocess.check_call(command + [text.encode('utf-8') if isinstance(text, unicode) else text])
+                os.rename(temp_file, path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('could not render {!r}: {}'.format(text, e))
+            return None
+        logger.debug('rendered {!r} to {}'.format(text, path))
+        self.evict()
+        return path
+
+    def evict(self):
+        """deletes the least recently used files above max_files"""
+        with self.lock:
+            files = [os.path.join(self.cache_path, name) for name in os.listdir(self.cache_path)
+                     if name.endswith('.wav')]
+            if len(files) <= self.max_files:
+                return
+            files.sort(key=os.path.getmtime)
+            for path in files[:len(files) - self.max_files]:
+                logger.debug('evicting {} from the speech cache'.format(path))
+                os.remove(path)
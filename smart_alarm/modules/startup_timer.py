@@ -0,0 +1,56 @@
+import threading
+import logging
+import os
+
+from modules.clock import monotonic
+from modules.metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer(object):
+    """
+    records when the steps of the startup were done, in seconds since the
+    process started (including the start of the python interpreter). The
+    steps of threads running in parallel can overlap.
+    """
+
+    def __init__(self):
+        self.start = monotonic() - process_age()
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def mark(self, step):
+        with self.lock:
+            self.steps.append((step, monotonic() - self.start))
+
+    def elapsed(self, step):
+        """seconds from the start of the process until step, None if it
+        wasn't done yet"""
+        with self.lock:
+            return dict(self.steps).get(step)
+
+    def log(self):
+        """logs the steps in the order they were done and the time since the
+        previous one, and publishes them as metrics"""
+        with self.lock:
+            steps = sorted(self.steps, key=lambda step: step[1])
+        previous = 0.0
+        for step, elapsed in steps:
+            registry.set('startup_seconds', elapsed, step=step)
+            logger.info('startup: {:<14} after {:>6.3f} sec (+{:.3f})'.format(step, elapsed, elapsed - previous))
+            previous = elapsed
+
+
+def process_age():
+    """seconds since the process was started, from /proc. 0 if unknown."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name in parentheses may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - float(fields[19]) / os.sysconf('SC_CLK_TCK'), 0.0)
+    except (IOError, OSError, IndexError, ValueError):
+        return 0.0
@@ -0,0 +1,128 @@
+import gzip
+import io
+import threading
+import os
+import logging
+
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from stat import S_ISREG
+from wsgiref.util import FileWrapper
+
+
+logger = logging.getLogger(__name__)
+
+# mime types which are worth compressing
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json')
+
+
+class StaticFiles(object):
+    """
+    serves static files from an in-memory cache. Every file is read and
+    gzip compressed once and reloaded only when its mtime or size changes.
+    Responses carry ETag and Last-Modified headers, so browsers revalidate
+    with a cheap 304. Files larger than max_cached_size are not cached but
+    streamed with wsgi.file_wrapper.
+    """
+
+    def __init__(self, content_type, max_cached_size=1024 * 1024):
+        # function returning the mime type of a path
+        self.content_type = content_type
+        self.max_cached_size = max_cached_size
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def serve(self, path, environ, start_response):
+        """returns the wsgi response for the given file, or None if it
+        does not exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+
+        etag = '"{:x}-{:x}"'.format(int(stat.st_mtime * 1000000), stat.st_size)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = [('content-type', self.content_type(path)),
+                   ('last-modified', last_modified),
+                   ('cache-control', 'no-cache')]
+
+        if stat.st_size > self.max_cached_size:
+            # streamed as is, there is no compressed variant
+            headers.append(('etag', etag))
+            if self.not_modified(environ, etag, stat.st_mtime):
+                start_response('304 Not Modified', headers)
+                return []
+            f = open(path, 'rb')
+            headers.append(('content-length', str(stat.st_size)))
+            try:
+                start_response('200 OK', headers)
+            except Exception:
+                f.close()
+                raise
+            # the server calls close() of the wrapper, which closes f
+            return environ.get('wsgi.file_wrapper', FileWrapper)(f, 64 * 1024)
+
+        entry = self.entry(path, etag)
+        headers.append(('vary', 'Accept-Encoding'))
+        gzipped = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '') and entry['gzip'] is not None
+        # a 304 carries the etag of the variant a 200 would have sent
+        headers.append(('etag', gzip_etag(etag) if gzipped else etag))
+        if self.not_modified(environ, etag, stat.st_mtime):
+            start_response('304 Not Modified', headers)
+            return []
+        if gzipped:
+            body = entry['gzip']
+            headers.append(('content-encoding', 'gzip'))
+        else:
+            body = entry['content']
+        headers.append(('content-length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+    def entry(self, path, etag):
+        """returns the cached content of path, (re)loading it if the file
+        changed since it was cached"""
+        with self.lock:
+            entry = self.cache.get(path)
+        if entry is not None and entry['etag'] == etag:
+            return entry
+
+        logger.debug('loading static file {}'.format(path))
+        with open(path, 'rb') as f:
+            content = f.read()
+        entry = {'etag': etag, 'content': content, 'gzip': None}
+        if self.content_type(path).startswith(COMPRESSIBLE_TYPES):
+            compressed = compress(content)
+            if len(compressed) < len(content):
+                entry['gzip'] = compressed
+        with self.lock:
+            self.cache[path] = entry
+        return entry
+
+    def not_modified(self, environ, etag, mtime):
+        """checks the conditional request headers If-None-Match and
+        If-Modified-Since against the current state of the file"""
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or gzip_etag(etag) in tags
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            date = parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= mktime_tz(date)
+        return False
+
+
+def gzip_etag(etag):
+    """the compressed variant needs its own etag"""
+    return etag[:-1] + '-gz"'
+
+
+def compress(content):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
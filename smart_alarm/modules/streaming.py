@@ -0,0 +1,208 @@
+import subprocess
+import threading
+import urllib2
+import time
+import os
+import logging
+
+from modules.cancellation import CancelToken
+from modules.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer(object):
+    """
+    bounded byte buffer between one writing and one reading thread. write()
+    blocks while the buffer is full, read() blocks while it is empty, until
+    close() marks the end of the data. abort() wakes up both sides.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.size = 0
+        self.closed = False
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def available(self):
+        with self.condition:
+            return self.size
+
+    def write(self, data):
+        """appends data, blocking while the buffer is full. Returns False if
+        the buffer was aborted."""
+        data = memoryview(data)
+        while len(data):
+            with self.condition:
+                while self.size == self.capacity and not self.aborted:
+                    self.condition.wait()
+                if self.aborted:
+                    return False
+                end = (self.start + self.size) % self.capacity
+                count = min(len(data), self.capacity - self.size, self.capacity - end)
+                self.buffer[end:end + count] = data[:count]
+                self.size += count
+                self.condition.notify_all()
+            data = data[count:]
+        return True
+
+    def read(self, max_size, timeout=None):
+        """returns up to max_size bytes. Returns an empty string if nothing
+        arrived within the timeout or the buffer is closed and empty."""
+        with self.condition:
+            if self.size == 0 and not self.closed and not self.aborted:
+                self.condition.wait(timeout)
+            count = min(max_size, self.size, self.capacity - self.start)
+            data = bytes(self.buffer[self.start:self.start + count])
+            self.start = (self.start + count) % self.capacity
+            self.size -= count
+            self.condition.notify_all()
+            return data
+
+    def wait_for(self, size, timeout=None):
+        """blocks until size bytes are buffered or the buffer is closed"""
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.size < size and not self.closed and not self.aborted:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.size
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    def finished(self):
+        """True if all data was written and read"""
+        with self.condition:
+            return (self.closed and self.size == 0) or self.aborted
+
+
+class StreamPlayer(object):
+    """
+    plays audio while it is still downloading. A download thread copies the
+    http response into a ring buffer and into save_file at the same time,
+    the decoder (mpg123 reading from stdin) is fed from the ring buffer as
+    soon as start_threshold bytes are buffered. Buffer underruns and the
+    time to the first audio (until the first bytes are handed to the
+    decoder) are reported in the returned statistics.
+    """
+
+    def __init__(self, command=('mpg123', '-q', '-'), ring_size=4 * 1024 * 1024,
+                 start_threshold=128 * 1024, chunk_size=16 * 1024, timeout=20):
+        self.command = list(command)
+        self.ring_size = ring_size
+        self.start_threshold = start_threshold
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+    def play(self, url, save_file=None, cancel=None, on_start=None):
+        """plays url until its end or until the CancelToken cancel is
+        cancelled, which aborts the buffer and kills the decoder right away.
+        on_start is called when the decoder gets the first data. Returns a dict with time_to_first_audio, underruns, underrun_time,
+        bytes, complete (download finished and saved) and the response
+        headers."""
+        cancel = cancel or CancelToken()
+        start_time = time.time()
+        ring = RingBuffer(self.ring_size)
+        stats = {'time_to_first_audio': None, 'underruns': 0, 'underrun_time': 0.0,
+                 'bytes': 0, 'complete': False, 'etag': None, 'last_modified': None}
+        downloader = threading.Thread(target=self.download, args=(url, ring, save_file, stats))
+        downloader.daemon = True
+        downloader.start()
+
+        # cancelling aborts the buffer, which wakes up every wait on it
+        cancel.add_callback(ring.abort)
+        ring.wait_for(self.start_threshold)
+        if cancel.cancelled():
+            return stats
+        if ring.available() == 0:
+            logger.warning('nothing to play from {}'.format(url))
+            return stats
+
+        decoder = subprocess.Popen(self.command, stdin=subprocess.PIPE)
+        cancel.add_callback(lambda: decoder.poll() is None and decoder.terminate())
+        stats['time_to_first_audio'] = time.time() - start_time
+        logger.info('playing {} after {:.2f} sec'.format(url, stats['time_to_first_audio']))
+        if on_start is not None:
+            on_start()
+        starved_since = None
+        try:
+            while not cancel.cancelled():
+                if starved_since is None and ring.available() == 0 and not ring.finished():
+                    # the download can't keep up with the playback
+                    stats['underruns'] += 1
+                    starved_since = time.time()
+                    logger.debug('buffer underrun while playing {}'.format(url))
+                data = ring.read(self.chunk_size)
+                if not data:
+                    if ring.finished():
+                        break
+                    continue
+                if starved_since is not None:
+                    stats['underrun_time'] += time.time() - starved_since
+                    starved_since = None
+                decoder.stdin.write(data)
+        except IOError as e:
+            # the decoder exited early
+            logger.warning('decoder of {} failed: {}'.format(url, e))
+        finally:
+            if not ring.finished() or cancel.cancelled():
+                # stopped or decoder failed, cancel the download as well
+                ring.abort()
+                if decoder.poll() is None:
+                    decoder.terminate()
+            try:
+                decoder.stdin.close()
+            except IOError:
+                pass
+            decoder.wait()
+        downloader.join(self.timeout)
+        logger.info('stream {} done: {}'.format(url, stats))
+        return stats
+
+    def download(self, url, ring, save_file, stats):
+        """copies the response into the ring buffer and save_file. The file
+        is written to a temporary name and only renamed when complete."""
+        temp_file = save_file + '.part' if save_file else None
+        f = None
+        try:
+            response = urllib2.urlopen(url, timeout=self.timeout)
+            stats['etag'] = response.info().getheader('ETag')
+            stats['last_modified'] = response.info().getheader('Last-Modified')
+            if temp_file:
+                f = open(temp_file, 'wb')
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                stats['bytes'] += len(chunk)
+                if f is not None:
+                    f.write(chunk)
+                if not ring.write(chunk):
+                    return
+            if f is not None:
+                f.close()
+                f = None
+                os.rename(temp_file, save_file)
+            stats['complete'] = True
+        except Exception as e:
+            logger.warning('download of {} failed: {}'.format(url, e))
+        finally:
+            registry.inc('download_bytes_total', stats['bytes'], source='stream')
+            if f is not None:
+                f.close()
+            if temp_file and os.path.exists(temp_file):
+                os.remove(temp_file)
+            ring.close()
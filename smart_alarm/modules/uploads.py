@@ -0,0 +1,141 @@
+import hashlib
+import threading
+import os
+import logging
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """raised for invalid upload requests, carries the matching http status"""
+
+    def __init__(self, message, status='400 Bad Request', offset=None):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class Uploads(object):
+    """
+    streams uploaded files to a partial file in bounded chunks while hashing
+    them. Interrupted uploads can be resumed at the offset returned by
+    offset(). finish() renames the completed file atomically into the
+    target directory, so other readers never see half written files.
+    """
+
+    def __init__(self, target_path=project_path + '/music', partial_path=project_path + '/uploads',
+                 chunk_size=64 * 1024, max_size=25000000):
+        self.target_path = target_path
+        self.partial_path = partial_path
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        # running sha1 hashes of the uploads in progress: {name: (offset, hash)}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.partial_path):
+            os.makedirs(self.partial_path)
+
+    def offset(self, name):
+        """returns the number of bytes already received for the given file"""
+        try:
+            return os.path.getsize(self.partial_file(name))
+        except OSError:
+            return 0
+
+    def write(self, name, stream, offset, length=None):
+        """appends the body in stream to the partial file, starting at offset.
+        Reads length bytes, or until the end of stream if length is None
+        (chunked requests). An offset of 0 restarts the upload. Returns the
+        new offset."""
+        partial_file = self.partial_file(name)
+        current_offset = self.offset(name)
+        if offset != 0 and offset != current_offset:
+            raise UploadError('upload of {} is at offset {}, not {}'.format(name, current_offset, offset),
+                              status='409 Conflict', offset=current_offset)
+        if length is not None and offset + length > self.max_size:
+            raise UploadError('file {} is larger than {} bytes'.format(name, self.max_size),
+                              status='413 Request Entity Too Large')
+
+        sha1 = self.running_hash(name, offset)
+        remaining = length
+        with open(partial_file, 'wb' if offset == 0 else 'ab') as f:
+            while remaining is None or remaining > 0:
+                chunk_size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                if offset > self.max_size:
+                    raise UploadError('file {} is larger than {} bytes'.format(name, self.max_size),
+                                      status='413 Request Entity Too Large')
+                f.write(chunk)
+                sha1.update(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+        with self.lock:
+            self.hashes[name] = (offset, sha1)
+        return offset
+
+    def finish(self, name, expected_sha1=None):
+        """verifies the hash of the completed upload and moves it to the target
+        directory. Returns the sha1 hex digest of the file."""
+        partial_file = self.partial_file(name)
+        if not os.path.isfile(partial_file):
+            raise UploadError('no upload in progress for {}'.format(name), status='404 Not Found')
+
+        digest = self.running_hash(name, self.offset(name)).hexdigest()
+        if expected_sha1 is not None and expected_sha1.lower() != digest:
+            self.discard(name)
+            raise UploadError('checksum mismatch for {}'.format(name), status='422 Unprocessable Entity')
+
+        with open(partial_file, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(partial_file, os.path.join(self.target_path, name))
+        with self.lock:
+            self.hashes.pop(name, None)
+        logger.info('upload of {} finished with sha1 {}'.format(name, digest))
+        return digest
+
+    def discard(self, name):
+        """deletes the partial file of the given upload"""
+        with self.lock:
+            self.hashes.pop(name, None)
+        try:
+            os.remove(self.partial_file(name))
+        except OSError:
+            pass
+
+    def running_hash(self, name, offset):
+        """returns a copy of the sha1 hash of the first offset bytes of the
+        upload. Uses the hash kept in memory and only re-reads the partial
+        file if the upload was started by another process or restarted."""
+        with self.lock:
+            hashed_offset, sha1 = self.hashes.get(name, (None, None))
+        if hashed_offset == offset:
+            return sha1.copy()
+
+        sha1 = hashlib.sha1()
+        if offset > 0:
+            with open(self.partial_file(name), 'rb') as f:
+                remaining = offset
+                while remaining > 0:
+                    chunk = f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    remaining -= len(chunk)
+        return sha1
+
+    def partial_file(self, name):
+        return os.path.join(self.partial_path, check_file_name(name) + '.part')
+
+
+def check_file_name(name):
+    """makes sure the given name is a plain file name without any path"""
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise UploadError('invalid file name: {}'.format(name))
+    return name
@@ -0,0 +1,42 @@
+import select
+import fcntl
+import errno
+import os
+
+
+class Wakeup(object):
+    """
+    wakes up a thread sleeping in wait(). Python 2 implements timed waits of
+    threading objects by polling, wait() sleeps in select() on a pipe
+    instead, until notify() is called or the timeout passed. A notify()
+    without a thread waiting makes the next wait() return right away.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def wait(self, timeout=None):
+        """returns True if notify() was called, False after the timeout"""
+        try:
+            readable, _, _ = select.select([self.read_fd], [], [], timeout)
+        except select.error as e:
+            # interrupted by a signal, the caller checks its state anyway
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if readable:
+            os.read(self.read_fd, 4096)
+        return bool(readable)
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, b'.')
+        except OSError as e:
+            # the pipe is full, so wait() will return anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
@@ -1,16 +1,20 @@
-import xml.etree.cElementTree as ET
-import copy
+import threading
+import atexit
 import os
 import logging
 
-from os import listdir
-from os.path import isfile, join
+from modules.music_library import MusicLibrary
+from modules.xml_store import XmlStore, data_path
+from modules.recurrence import Alarm, default_alarm_id
 
 
 # read environmental variable for project path
 project_path = os.environ['smart_alarm_path']
 logger = logging.getLogger(__name__)
 
+# the settings, shared by the daemon and the web server
+data_file = data_path + '/data.xml'
+
 
 class Xml_data(object):
     """
@@ -20,7 +24,22 @@ class Xml_data(object):
 
     def __init__(self, xml_file):
         self.xml_path = xml_file
-        self.xmldoc = ET.parse(self.xml_path)
+        self.music_path = project_path + '/music'
+        self.library = MusicLibrary(self.music_path)
+        self.store = XmlStore(self.xml_path)
+        # xmldoc is a read-only snapshot, writes replace it by a new one
+        self.xmldoc, self.xml_stamp = self.store.load()
+        self.fields = self.read_fields()
+        # set after own writes, which may include changes of other processes
+        self.fields_stale = False
+        self.music_stamp = None
+        # changes collected by changeValues, waiting to be written by flush
+        self.pending = {}
+        self.flush_timer = None
+        self.write_lock = threading.RLock()
+        # optional function, called with the changes after each flush
+        self.on_flush = None
+        atexit.register(self.flush)
         self.readFileNamesInMusicDirectory()
 
     def alarm_active(self):
@@ -53,43 +72,152 @@ class Xml_data(object):
     def test_alarm(self):
         return self.xmldoc.find('test_alarm').text
 
-    def read_data(self):
-        """reads the data.xml file and returns the data of the whole
-        file as a string. Used for detecting changes in the file."""
-        self.xmldoc = ET.parse(self.xml_path)
-        self.readFileNamesInMusicDirectory()
+    def alarms(self):
+        """returns all alarms as list of recurrence.Alarm objects: the main
+        alarm (alarm_time, days, content) and the ones in <alarms>. Empty if
+        alarm_active, the main switch, is off. Broken entries are skipped."""
+        if self.alarm_active() != '1':
+            return []
+        alarms = []
+        try:
+            alarms.append(Alarm('main', self.alarm_time(), days=self.alarm_days() or '', content=self.content()))
+        except (ValueError, AttributeError) as e:
+            logger.warning("skipping invalid main alarm: {}".format(e))
+        alarms_node = self.xmldoc.find('alarms')
+        for number, node in enumerate(alarms_node if alarms_node is not None else []):
+            try:
+                alarms.append(alarm_from_attributes(node.attrib, number))
+            except (ValueError, KeyError) as e:
+                logger.warning("skipping invalid alarm {}: {}".format(node.attrib, e))
+        return alarms
 
-        with open(self.xml_path) as infile:
-            data = infile.read()
-        return data
+    def read_data(self):
+        """checks if the data.xml file or the music directory changed on disk
+        since the last call (by comparing mtime, size and inode) and re-parses
+        the file only in that case. Returns a dict of the changed fields in the
+        form {element_name: (old_value, new_value)}, which is empty if nothing
+        changed. Cheap enough to be called every second."""
+        xml_stamp = file_stamp(self.xml_path)
+        music_stamp = file_stamp(self.music_path)
+        if xml_stamp != self.xml_stamp:
+            self.xmldoc, self.xml_stamp = self.store.load()
+        elif music_stamp == self.music_stamp and not self.fields_stale:
+            return {}
+        if music_stamp != self.music_stamp:
+            self.readFileNamesInMusicDirectory()
+
+        old_fields = self.fields
+        self.fields = self.read_fields()
+        self.fields_stale = False
+        return fields_diff(old_fields, self.fields)
+
+    def read_fields(self):
+        """returns all settings of the parsed xml file as a dict. Lists like
+        the mp3 tracks or the alarms are stored as tuples."""
+        fields = {}
+        for element in self.xmldoc.getroot():
+            if element.tag in ('mp3_files', 'alarms'):
+                fields[element.tag] = field_value([child.attrib or child.text for child in element])
+            else:
+                fields[element.tag] = element.text
+        return fields
 
     def changeValue(self, element_name, value):
         """Allows editing the xml-file, by passing the elements-
         name and the desired value."""
-        logger.warning("XML CHANGE: element: {}; value: {}".format(element_name, value))
-        self.xmldoc.find(element_name).text = value
-        self.writeFile()
-
-    def writeFile(self):
-        self.xmldoc.write(self.xml_path)
+        self.changeValues({element_name: value})
+
+    def changeValues(self, changes, delay=0):
+        """applies several changes {element_name: value} as one transaction:
+        if one of the elements doesn't exist, nothing is changed. With a delay
+        (in seconds) the file is not written right away, instead all changes
+        arriving within the delay are written together by a single flush."""
+        for element_name in changes:
+            if self.xmldoc.find(element_name) is None:
+                raise KeyError('unknown xml element: {}'.format(element_name))
+
+        with self.write_lock:
+            self.pending.update(changes)
+            if delay <= 0:
+                self.flush()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """writes all pending changes to the xml file at once"""
+        with self.write_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending:
+                return
+            changes, self.pending = self.pending, {}
+            for element_name, value in changes.items():
+                logger.warning("XML CHANGE: element: {}; value: {}".format(element_name, value))
+            self.commit(changes)
+
+        if self.on_flush is not None:
+            self.on_flush(changes)
+
+    def commit(self, changes):
+        """writes the changes to the latest version of the file and swaps in
+        the new snapshot. Own changes are not reported as change events by
+        read_data, since the caller already knows about them, but changes of
+        other processes picked up on the way are."""
+        with self.write_lock:
+            self.xmldoc, self.xml_stamp = self.store.commit(changes)
+            self.fields = dict(self.fields)
+            for element_name, value in changes.items():
+                self.fields[element_name] = field_value(value)
+            self.fields_stale = True
 
     def readFileNamesInMusicDirectory(self):
-        mp3_tracks_node = self.xmldoc.find('mp3_files')
-        mp3_tracks_node_old = copy.deepcopy(mp3_tracks_node)
-        mp3_tracks_node.clear()
-        fileNames = [f for f in listdir(project_path + '/music') if isfile(join(project_path + '/music', f))]
-        for file in fileNames:
-            node = ET.SubElement(mp3_tracks_node, 'track')
-            node.text = file
-
-        if not elements_equal(mp3_tracks_node, mp3_tracks_node_old):
-            self.xmldoc.write(self.xml_path)
-
-
-def elements_equal(e1, e2):
-    if e1.tag != e2.tag: return False
-    if e1.text != e2.text: return False
-    if e1.tail != e2.tail: return False
-    if e1.attrib != e2.attrib: return False
-    if len(e1) != len(e2): return False
-    return all(elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+        """brings the music library index up to date and writes its track
+        names to the <mp3_files> node, if they differ from the current ones"""
+        self.music_stamp = file_stamp(self.music_path)
+        self.library.sync()
+        file_names = self.library.tracks()
+        if [track.text for track in self.xmldoc.find('mp3_files')] != file_names:
+            self.commit({'mp3_files': file_names})
+
+
+def file_stamp(path):
+    """returns (mtime, size, inode) of the given path, or None if it doesn't
+    exist. Comparing two stamps tells if a file was changed or replaced."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def field_value(value):
+    """makes lists of strings or attribute dicts comparable"""
+    if isinstance(value, (list, tuple)):
+        return tuple(tuple(sorted(item.items())) if isinstance(item, dict) else item for item in value)
+    return value
+
+
+def alarm_from_attributes(attributes, number):
+    """creates an Alarm from the attributes of an <alarm> element, e.g.
+    <alarm time="06:30" days="1,2,3,4,5" skip="2026-12-24" content="podcast"/>
+    or <alarm time="09:00" rrule="FREQ=WEEKLY;INTERVAL=2;BYDAY=SA"/>"""
+    return Alarm(attributes.get('id', default_alarm_id(number)),
+                 attributes['time'],
+                 days=attributes.get('days'),
+                 rrule=attributes.get('rrule'),
+                 skip_dates=attributes.get('skip', '').split(','),
+                 content=attributes.get('content'),
+                 active=attributes.get('active', '1') == '1')
+
+
+def fields_diff(old_fields, new_fields):
+    """returns {name: (old_value, new_value)} for all fields which differ"""
+    changes = {}
+    for name in set(old_fields) | set(new_fields):
+        if old_fields.get(name) != new_fields.get(name):
+            changes[name] = (old_fields.get(name), new_fields.get(name))
+    return changes
+
@@ -0,0 +1,154 @@
+import xml.etree.cElementTree as ET
+import fcntl
+import json
+import threading
+import os
+import logging
+
+from contextlib import contextmanager
+from stat import S_IMODE
+
+
+# read environmental variable for project path
+project_path = os.environ['smart_alarm_path']
+logger = logging.getLogger(__name__)
+
+# data.xml and the other files written by both the daemon (root) and the web
+# server (www-data). Only this directory is writable for the group www-data,
+# see autostart.sh
+data_path = project_path + '/data'
+# the files there are writable for the group, whichever process created them
+SHARED_MODE = 0o664
+
+# tag of the child elements of elements holding a list
+CHILD_TAGS = {'mp3_files': 'track', 'alarms': 'alarm'}
+
+
+class XmlStore(object):
+    """
+    crash- and concurrency-safe storage of the xml settings file.
+    Writers are serialized across threads and processes by a lock file.
+    Every change is first recorded in a journal, then the new file is written
+    to a temporary file and renamed over the old one, so readers always see
+    either the old or the new file, never a half written one. A journal left
+    behind by a crash is replayed on the next start.
+    """
+
+    def __init__(self, xml_path):
+        self.xml_path = xml_path
+        self.lock_path = xml_path + '.lock'
+        self.journal_path = xml_path + '.journal'
+        self.temp_path = xml_path + '.tmp'
+        self.thread_lock = threading.Lock()
+        self.recover()
+
+    def load(self):
+        """parses the current file without locking and returns (tree, stamp).
+        The returned tree is never modified afterwards and can be used as
+        snapshot by readers."""
+        with open(self.xml_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            tree = ET.parse(f)
+        return tree, (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def commit(self, changes):
+        """applies the changes {element_name: value} to the latest version of
+        the file and returns the new (tree, stamp). A list as value replaces
+        the children of the element, strings become their text and dicts
+        their attributes."""
+        with self.locked():
+            self.write_journal(changes)
+            try:
+                result = self.apply(changes)
+            finally:
+                os.remove(self.journal_path)
+        return result
+
+    def recover(self):
+        """replays a journal left behind by an interrupted write"""
+        with self.locked():
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+            if not os.path.exists(self.journal_path):
+                return
+            try:
+                with open(self.journal_path) as f:
+                    changes = json.load(f)
+            except ValueError:
+                # the journal itself wasn't completely written, so the
+                # settings file was not touched yet
+                logger.warning('discarding incomplete journal {}'.format(self.journal_path))
+            else:
+                logger.warning('recovering interrupted change of {}: {}'.format(self.xml_path, changes))
+                try:
+                    self.apply(changes)
+                except KeyError as e:
+                    logger.warning('could not recover change: {}'.format(e))
+            os.remove(self.journal_path)
+
+    def apply(self, changes):
+        tree, _ = self.load()
+        for element_name, value in changes.items():
+            element = tree.find(element_name)
+            if element is None:
+                raise KeyError('unknown xml element: {}'.format(element_name))
+            if isinstance(value, (list, tuple)):
+                element.clear()
+                for item in value:
+                    if isinstance(item, dict):
+                        ET.SubElement(element, CHILD_TAGS[element_name], item)
+                    else:
+                        ET.SubElement(element, CHILD_TAGS[element_name]).text = item
+            else:
+                element.text = value
+        return tree, self.write(tree)
+
+    def write(self, tree):
+        """writes the tree atomically and returns the stamp of the new file"""
+        mode = S_IMODE(os.stat(self.xml_path).st_mode)
+        with open(self.temp_path, 'wb') as f:
+            tree.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+            os.fchmod(f.fileno(), mode)
+            stat = os.fstat(f.fileno())
+        os.rename(self.temp_path, self.xml_path)
+        fsync_directory(self.xml_path)
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def write_journal(self, changes):
+        with open(self.journal_path, 'w') as f:
+            share(f)
+            json.dump(changes, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextmanager
+    def locked(self):
+        """exclusive lock, held by only one thread of one process at a time"""
+        with self.thread_lock:
+            with open(self.lock_path, 'a') as lock:
+                share(lock)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def share(f):
+    """makes the file writable for the group of the data directory. Only the
+    owner may change the mode, for the others it was done already."""
+    try:
+        os.fchmod(f.fileno(), SHARED_MODE)
+    except OSError:
+        pass
+
+
+def fsync_directory(path):
+    """makes sure a rename in the directory of path is written to disk"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
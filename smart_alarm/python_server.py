@@ -2,8 +2,10 @@ import cgi
 import sys
 import os.path
 import logging
-
-import base64   # for decoding mp3 data from web server
+import json
+import threading
+import time
+import urlparse
 
 # important for apache web server:
 project_path = os.environ["smart_alarm_path"]
@@ -11,13 +13,40 @@ if project_path not in sys.path:
     sys.path.append(project_path)
 #os.chdir(project_path)
 
-from modules.xml_data import Xml_data
+from modules.xml_data import Xml_data, data_file
+from modules.uploads import Uploads, UploadError
+from modules.static_files import StaticFiles
+from modules.events import EventLog
+from modules import metrics
+from modules.metrics import registry
+import settings
 
 
 logger = logging.getLogger(__name__)
 
 
-xml_data = Xml_data(str(project_path) + '/data.xml')
+xml_data = Xml_data(data_file)
+uploads = Uploads()
+event_log = EventLog()
+daemon_metrics = metrics.SnapshotFile(metrics.daemon_file)
+
+
+def settings_written(changes):
+    """informs the web interface after settings were written to data.xml"""
+    registry.inc('settings_writes_total')
+    event_log.publish('settings', changes)
+
+
+xml_data.on_flush = settings_written
+
+# settings changes arriving within this time (in seconds) are written at once
+settings_write_delay = 0.5
+max_settings_size = 64 * 1024
+
+# long-polling requests block a server thread, so only allow a few of them
+max_event_waiters = 2
+event_waiters = [0]
+event_waiters_lock = threading.Lock()
 
 MIME_TABLE = {'.txt': 'text/plain',
               '.html': 'text/html',
@@ -28,7 +57,41 @@ MIME_TABLE = {'.txt': 'text/plain',
 
 
 def application(environ, start_response):
-    logger.warning("python_server application started")
+    """counts the requests and measures their latency per path"""
+    start_time = time.time()
+    statuses = []
+
+    def counting_start_response(status, headers, exc_info=None):
+        statuses.append(status.split(' ', 1)[0])
+        return start_response(status, headers, exc_info)
+
+    try:
+        return route(environ, counting_start_response)
+    finally:
+        path = metrics_path(environ['PATH_INFO'])
+        registry.inc('http_requests_total', path=path, method=environ['REQUEST_METHOD'],
+                     status=statuses[-1] if statuses else '500')
+        registry.observe('http_request_duration_seconds', time.time() - start_time, path=path)
+
+
+def metrics_path(path):
+    """the path label of the request metrics, all static files share one"""
+    if path in ('/', '/upload', '/events', '/settings', '/metrics', '/data.xml'):
+        return path
+    return 'static'
+
+
+def route(environ, start_response):
+    logger.debug("python_server application started")
+    if environ['PATH_INFO'] == '/metrics':
+        return metrics_app(environ, start_response)
+    if environ['PATH_INFO'] == '/upload':
+        return upload_app(environ, start_response)
+    if environ['PATH_INFO'] == '/events':
+        return events_app(environ, start_response)
+    if environ['PATH_INFO'] == '/settings':
+        return settings_app(environ, start_response)
+
     # response for POST
     if environ['REQUEST_METHOD'] == 'POST':
         post = cgi.FieldStorage(
@@ -37,47 +100,181 @@ def application(environ, start_response):
            keep_blank_values=False
         )
 
-        uploaded_mp3_file = {}
         for s in post:
-            if 'uploadMp3File' in s:
-                fieldName = s[s.find('[')+1:s.find(']')]
-                uploaded_mp3_file[fieldName] = post.getvalue(s)
-            elif s == 'deleteMp3File':
+            if s == 'deleteMp3File':
                 os.remove('./music/' + post.getvalue(s))
+                xml_data.library.remove(post.getvalue(s))
                 xml_data.readFileNamesInMusicDirectory()
+                event_log.publish('library', {'deleted': post.getvalue(s)})
             else:
                 try:
-                    xml_data.changeValue(s, post.getvalue(s))
+                    settings.validate(s, post.getvalue(s))
+                    xml_data.changeValues({s: post.getvalue(s)}, delay=settings_write_delay)
                     logger.warning("{} changed to {}".format(s, post.getvalue(s)))
                 except Exception as e:
                     logger.warning("Error: Couldn't change xml entry {} to {} with error: {}".format(s, post.getvalue(s), e))
 
-        if uploaded_mp3_file:
-            mp3_data_base64 = uploaded_mp3_file['fileData'][uploaded_mp3_file['fileData'].find('base64,')+7:]
-            # mp3_data = decode_base64(mp3_data_base64)
-            f = open('./music/' + uploaded_mp3_file['name'], 'w')
-            f.write(base64.b64decode(mp3_data_base64))
-            f.close()
-            xml_data.readFileNamesInMusicDirectory()
-
     path = environ['PATH_INFO']
     if path != '/data.xml':
         path = './web' + path
     else:
-        path = '.' + path
-
-    if os.path.exists(path):
-        if path == './web/':
-            path = './web/index.html'
-        h = open(path, 'rb')
-        content = h.read()
-        h.close()
-
-        headers = [('content-type', content_type(path))]
-        start_response('200 OK', headers)
-        return [content]
-    else:
+        path = data_file
+
+    if path == './web/':
+        path = './web/index.html'
+    response = static_files.serve(path, environ, start_response)
+    if response is None:
         return show_404_app(environ, start_response, path)
+    return response
+
+
+def upload_app(environ, start_response):
+    """streaming mp3 upload. GET /upload?name=<file> returns the offset to
+    resume an interrupted upload at. PUT/POST /upload?name=<file>&offset=<n>
+    appends the raw (or chunked) request body to the file. The last request
+    sets final=1 (and optionally sha1=<hex>) to move the file to ./music."""
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    name = query.get('name', [''])[0]
+    response = {'name': name}
+    try:
+        if environ['REQUEST_METHOD'] == 'GET':
+            response['offset'] = uploads.offset(name)
+        elif environ['REQUEST_METHOD'] in ('PUT', 'POST'):
+            offset = int(query.get('offset', ['0'])[0])
+            length = environ.get('CONTENT_LENGTH')
+            if length:
+                length = int(length)
+            elif environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+                length = None
+            else:
+                raise UploadError('content length required', status='411 Length Required')
+            start_time = time.time()
+            response['offset'] = uploads.write(name, environ['wsgi.input'], offset, length)
+            received = response['offset'] - offset
+            registry.inc('upload_bytes_total', received)
+            registry.observe('upload_throughput_bytes_per_second', received / max(time.time() - start_time, 1e-3))
+            if query.get('final', ['0'])[0] == '1':
+                response['sha1'] = uploads.finish(name, query.get('sha1', [None])[0])
+                xml_data.library.add(name)
+                xml_data.readFileNamesInMusicDirectory()
+                event_log.publish('library', {'added': name})
+        else:
+            raise UploadError('method not allowed', status='405 Method Not Allowed')
+    except (UploadError, ValueError) as e:
+        logger.warning("Error: upload of {} failed with error: {}".format(name, e))
+        response['error'] = str(e)
+        if getattr(e, 'offset', None) is not None:
+            response['offset'] = e.offset
+        start_response(getattr(e, 'status', '400 Bad Request'), [('content-type', 'application/json')])
+        return [json.dumps(response)]
+
+    start_response('200 OK', [('content-type', 'application/json')])
+    return [json.dumps(response)]
+
+
+def settings_app(environ, start_response):
+    """batched settings update. POST /settings with a json object of
+    {setting: value} validates all values and applies them as one
+    transaction, either all or none. Writes of batches arriving within
+    settings_write_delay are coalesced into a single write of data.xml."""
+    if environ['REQUEST_METHOD'] != 'POST':
+        start_response('405 Method Not Allowed', [('content-type', 'application/json')])
+        return [json.dumps({'error': 'method not allowed'})]
+
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length > max_settings_size:
+            raise ValueError('request too large')
+        changes = json.loads(environ['wsgi.input'].read(length))
+        if not isinstance(changes, dict):
+            raise ValueError('expected a json object')
+    except ValueError as e:
+        start_response('400 Bad Request', [('content-type', 'application/json')])
+        return [json.dumps({'error': str(e)})]
+
+    changes = dict((str(name), json_setting(value)) for name, value in changes.items())
+    errors = {}
+    for name, value in changes.items():
+        try:
+            settings.validate(name, value)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors[name] = '{}: {}'.format(type(e).__name__, e)
+    if not errors:
+        try:
+            xml_data.changeValues(changes, delay=settings_write_delay)
+        except KeyError as e:
+            errors[''] = str(e)
+    if errors:
+        logger.warning("Error: rejected settings {} with errors: {}".format(changes, errors))
+        start_response('400 Bad Request', [('content-type', 'application/json')])
+        return [json.dumps({'errors': errors})]
+
+    logger.warning("settings changed: {}".format(changes))
+    start_response('200 OK', [('content-type', 'application/json')])
+    return [json.dumps({'applied': changes})]
+
+
+def json_setting(value):
+    """converts a json value to the strings stored in data.xml. Lists (like
+    the alarms) keep their structure."""
+    if isinstance(value, list):
+        return [json_setting(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(key), json_setting(item)) for key, item in value.items())
+    return unicode(value)
+
+
+def events_app(environ, start_response):
+    """long-polling event stream. GET /events returns the current version,
+    GET /events?since=<version> waits until there are newer events (settings,
+    library, alarm status) or the timeout passed and returns them together
+    with the new version to continue with."""
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    response = {'events': [], 'version': event_log.version()}
+    try:
+        since = query.get('since')
+        timeout = min(float(query.get('timeout', ['25'])[0]), 60)
+        if since is not None:
+            since = int(since[0])
+            with event_waiters_lock:
+                may_wait = event_waiters[0] < max_event_waiters
+                if may_wait:
+                    event_waiters[0] += 1
+            if may_wait:
+                try:
+                    response['events'] = event_log.wait(since, timeout)
+                finally:
+                    with event_waiters_lock:
+                        event_waiters[0] -= 1
+            else:
+                # too many clients waiting, tell this one to come back later
+                response['events'] = event_log.since(since)
+                response['retry'] = 5000
+            if response['events']:
+                response['version'] = response['events'][-1]['seq']
+            else:
+                response['version'] = max(since, event_log.version())
+    except ValueError as e:
+        start_response('400 Bad Request', [('content-type', 'application/json')])
+        return [json.dumps({'error': str(e)})]
+
+    start_response('200 OK', [('content-type', 'application/json'), ('cache-control', 'no-cache')])
+    return [json.dumps(response)]
+
+
+def metrics_app(environ, start_response):
+    """counters of the web server and the alarm daemon in the prometheus
+    text format. The daemon writes its counters to a file every few
+    seconds."""
+    snapshots = []
+    daemon = daemon_metrics.read()
+    if daemon is not None:
+        registry.set('daemon_metrics_age_seconds', time.time() - daemon['time'])
+    snapshots.append(('web', registry.snapshot()))
+    if daemon is not None:
+        snapshots.append(('daemon', daemon))
+    start_response('200 OK', [('content-type', 'text/plain; version=0.0.4'), ('cache-control', 'no-cache')])
+    return [metrics.render(snapshots).encode('utf-8')]
 
 
 def content_type(path):
@@ -92,6 +289,9 @@ def content_type(path):
         return "application/octet-stream"
 
 
+static_files = StaticFiles(content_type)
+
+
 def show_404_app(environ, start_response, path):
     start_response('404 Not Found', [('content-type','text/html')])
     return ["""<html><h1>""" + path + """ not Found</h1><p>
@@ -100,14 +300,16 @@ def show_404_app(environ, start_response, path):
                </html>""", ]
 
 
-if __name__ == '__main__':
+def serve_wsgiref(port):
+    """the single threaded development server of wsgiref: one request at a
+    time, without keep-alive"""
     from wsgiref.simple_server import make_server
     import webbrowser
 
-    httpd = make_server('', 8090, application)
-    logger.debug('Serving on port 8090...')
+    httpd = make_server('', port, application)
+    logger.debug('Serving on port {}...'.format(port))
 
-    url = "http://127.0.0.1:8090"
+    url = "http://127.0.0.1:{}".format(port)
     webbrowser.open(url)
 
     try:
@@ -120,3 +322,33 @@ if __name__ == '__main__':
     except:
         httpd.server_close()
         logger.error('Error')
+
+
+def serve(port, threads):
+    """standalone server without apache, runs next to the alarm daemon.
+    Stops gracefully on SIGTERM and SIGINT."""
+    from modules.http_server import ThreadPoolServer
+    import signal
+
+    server = ThreadPoolServer(('', port), application, threads=threads)
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda number, frame: server.stop())
+    server.serve()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='smart alarm web interface')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--threads', type=int, default=8, help='number of connections served at once')
+    parser.add_argument('--wsgiref', action='store_true', help='use the single threaded wsgiref server')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    # the static files are looked up relative to the project
+    os.chdir(project_path)
+    if args.wsgiref:
+        serve_wsgiref(args.port)
+    else:
+        serve(args.port, args.threads)
@@ -1,7 +1,82 @@
 # -*- coding: utf-8 -*-
+from modules.recurrence import Alarm, default_alarm_id
 
-cont_set = set(['news', 'music'])
+cont_set = set(['news', 'music', 'podcast', 'mp3', 'stream'])
 days_set = set(['never', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'])
+# the days of data.xml, like time.strftime('%w'): 0 = sunday
+day_numbers = set(['0', '1', '2', '3', '4', '5', '6'])
+flag_set = set(['0', '1'])
+text_settings = set(['text', 'content_podcast_url', 'content_stream_url'])
+# the attributes of an <alarm> element in data.xml
+alarm_attributes = set(['id', 'time', 'days', 'rrule', 'skip', 'content', 'active'])
+
+
+def validate(name, value):
+    """checks a single setting as sent by the web interface and raises a
+    ValueError if the name is unknown or the value is not allowed"""
+    if name == 'content':
+        if value not in cont_set:
+            raise ValueError('unknown content: {}'.format(value))
+    elif name == 'days':
+        validate_days(value)
+    elif name == 'alarm_time':
+        validate_time(value)
+    elif name in ('alarm_active', 'individual_message', 'test_alarm'):
+        if value not in flag_set:
+            raise ValueError('{} has to be 0 or 1, not {}'.format(name, value))
+    elif name == 'alarms':
+        # list of alarms, each a dict of the attributes of an <alarm> element
+        if not isinstance(value, list):
+            raise ValueError('alarms have to be a list')
+        # the alarm set by alarm_time and days is called main
+        alarm_ids = set(['main'])
+        for number, attributes in enumerate(value):
+            validate_alarm(attributes, number)
+            alarm_id = attributes.get('id', default_alarm_id(number))
+            if alarm_id in alarm_ids:
+                raise ValueError('duplicate alarm id: {}'.format(alarm_id))
+            alarm_ids.add(alarm_id)
+    elif name == 'volume':
+        if not 0 <= float(value) <= 100:
+            raise ValueError('volume has to be between 0 and 100, not {}'.format(value))
+    elif name not in text_settings:
+        raise ValueError('unknown setting: {}'.format(name))
+
+
+def validate_days(value):
+    # comma separated day numbers (0 = sunday), empty if no day is set
+    for day in value.split(',') if value else []:
+        if day not in day_numbers:
+            raise ValueError('unknown day: {}'.format(day))
+
+
+def validate_time(value):
+    hours, _, minutes = value.partition(':')
+    if not (hours.isdigit() and minutes.isdigit() and int(hours) < 24 and int(minutes) < 60):
+        raise ValueError('invalid alarm time: {}'.format(value))
+
+
+def validate_alarm(attributes, number):
+    """checks the attributes of one <alarm> element, all of them are
+    written to data.xml as strings"""
+    if not isinstance(attributes, dict):
+        raise ValueError('alarm {} has to be an object'.format(number))
+    for key, value in attributes.items():
+        if key not in alarm_attributes:
+            raise ValueError('unknown alarm attribute: {}'.format(key))
+        if not isinstance(value, basestring):
+            raise ValueError('alarm attribute {} has to be a string'.format(key))
+    validate_time(attributes['time'])
+    if 'days' not in attributes and not attributes.get('rrule'):
+        # it would never ring
+        raise ValueError('alarm {} needs days or an rrule'.format(number))
+    validate_days(attributes.get('days', ''))
+    if attributes.get('content', 'news') not in cont_set:
+        raise ValueError('unknown content: {}'.format(attributes['content']))
+    if attributes.get('active', '1') not in flag_set:
+        raise ValueError('active has to be 0 or 1, not {}'.format(attributes['active']))
+    Alarm(attributes.get('id', default_alarm_id(number)), attributes['time'], days=attributes.get('days'),
+          rrule=attributes.get('rrule'), skip_dates=attributes.get('skip', '').split(','))
 
 
 class Settings(object):
@@ -1,6 +1,7 @@
 $(function() {
     $(window).load(function() {
         loadDoc();
+        listenForEvents();
     });
 
     // Global Variables
@@ -93,6 +94,70 @@ $(function() {
     };
 
 
+    //---------------------------------------------------
+    // Save settings
+    //---------------------------------------------------
+    // collects changed settings for a short moment and sends them to the
+    // server as one batch, e.g. while turning the knobs or ticking days
+    var pendingSettings = {};
+    var pendingSettingsTimer = null;
+
+    function saveSettings(changes) {
+        for (var name in changes) {
+            pendingSettings[name] = String(changes[name]);
+        }
+        clearTimeout(pendingSettingsTimer);
+        pendingSettingsTimer = setTimeout(function() {
+            var batch = pendingSettings;
+            pendingSettings = {};
+            $.ajax({
+                url: "settings",
+                type: "POST",
+                data: JSON.stringify(batch),
+                contentType: "application/json",
+                dataType: "json"
+            }).fail(function(xhr) {
+                console.log("saving settings failed: " + xhr.responseText);
+                loadDoc();
+            });
+        }, 300);
+    };
+
+
+    //---------------------------------------------------
+    // Server events
+    //---------------------------------------------------
+    // long-polls the server for settings, library and alarm status changes
+    // and reloads data.xml as soon as something changed
+    async function listenForEvents() {
+        var version = null;
+        while (true) {
+            try {
+                var url = "events" + (version === null ? "" : "?since=" + version);
+                var response = await $.ajax({url: url, dataType: "json", cache: false});
+                var reload = false;
+                for (var i = 0; i < response.events.length; i++) {
+                    var event = response.events[i];
+                    if (event.type == "alarm") {
+                        $("#alarm_status").text("Alarm " + event.data.status);
+                    } else {
+                        reload = true;
+                    }
+                }
+                if (reload) {
+                    loadDoc();
+                }
+                version = response.version;
+                if (response.retry) {
+                    await sleep(response.retry);
+                }
+            } catch (error) {
+                await sleep(5000);
+            }
+        }
+    };
+
+
     //---------------------------------------------------
     // Clock and Date
     //---------------------------------------------------
@@ -137,10 +202,7 @@ $(function() {
     $('#cb_alarm_active').change(function() {
         showOrHideAlarmActiveClass();
         var value = $(this).is(":checked") ? 1 : 0;
-        $.post("index.html",
-        {
-          alarm_active: value,
-        });
+        saveSettings({alarm_active: value});
     });
     
     // show or hide gui elements according if alarm_active is checked
@@ -168,19 +230,13 @@ $(function() {
             sList = sList.substr(0, sList.length-1)
         }
 
-        $.post("index.html",
-        {
-          days: sList,
-        });
+        saveSettings({days: sList});
     });
 
     $('#cb_individual_message').change(function() {
         showOrHideIndividualMessage();
         var value = $(this).is(":checked") ? 1 : 0;
-        $.post("index.html",
-        {
-          individual_message: value,
-        });
+        saveSettings({individual_message: value});
     });
     
     // show or hide gui elements according if individual_message is checked
@@ -239,10 +295,7 @@ $(function() {
             if (!initializing)
             {
                 console.log("new alarm time: " + value);
-                $.post("index.html",
-                {
-                  alarm_time: value,
-                });
+                saveSettings({alarm_time: value});
             }
 
         },
@@ -307,10 +360,7 @@ $(function() {
             if(!initializing)
             {
                 console.log("volume value : " + norm_val);
-                $.post("index.html",
-                    {
-                      volume: norm_val,
-                    });
+                saveSettings({volume: norm_val});
             }
         },
 
@@ -328,10 +378,7 @@ $(function() {
         select: function( event, ui ) {
             //save in xml file
             console.log("selected content selected : " + ui.item.value)
-            $.post("index.html",
-                {
-                  content: ui.item.value,
-                });
+            saveSettings({content: ui.item.value});
         },
 
         change: function( event, ui ) {
@@ -361,24 +408,15 @@ $(function() {
 
         if(this.id == "txt_individual_message")
         {
-            $.post("index.html",
-                {
-                  text: this.value,
-                });
+            saveSettings({text: this.value});
         }
         if(this.id == "txt_content_stream_url")
         {
-            $.post("index.html",
-                {
-                  content_stream_url: this.value,
-                });
+            saveSettings({content_stream_url: this.value});
         }
         else if(this.id == "txt_content_podcast_url")
         {
-            $.post("index.html",
-                {
-                  content_podcast_url: this.value,
-                });
+            saveSettings({content_podcast_url: this.value});
         }
     });
 
@@ -386,7 +424,7 @@ $(function() {
     //---------------------------------------------------
     // MP3 list box
     //---------------------------------------------------
-    $('#btn_del_mp3_list').click(async function() {
+    $('#btn_del_mp3_list').click(function() {
         // remove one array element with splice
         var index = $("#sel_mp3_list")[0].value;
         console.log("delete" + mp3Array[index])
@@ -395,11 +433,9 @@ $(function() {
         {
           deleteMp3File: mp3Array[index],
         });
-        await sleep(1000);
-        loadDoc();
     });
     
-    $('#btn_add_mp3_list').change(function(event, ui ) {
+    $('#btn_add_mp3_list').change(async function(event, ui ) {
         var uploadedFile = event.target.files[0];
         
         if(uploadedFile.size > 25000000)
@@ -407,27 +443,52 @@ $(function() {
             alert("The size of the mp3 file has to be less than 25 MB.");
             return;
         }
-        
-        var senddata = new Object();
-        senddata.name = uploadedFile.name;
-        senddata.date = uploadedFile.lastModified;
-        senddata.size = uploadedFile.size;
-        senddata.type = uploadedFile.type;
-
-        var reader = new FileReader();
-        reader.onload = async function(){
-            senddata.fileData = reader.result;
-            $.post("index.html",
-                {
-                  uploadMp3File: senddata,
-                });
-            await sleep(1000);
-            loadDoc();
-        };
-        reader.readAsDataURL(uploadedFile);
-        
+
+        try {
+            await uploadMp3File(uploadedFile);
+        } catch (error) {
+            console.log("upload of " + uploadedFile.name + " failed");
+            alert("Uploading " + uploadedFile.name + " failed, please try again.");
+        }
     });
 
+    // streams the file in slices as raw request bodies. If a slice fails,
+    // the upload resumes at the offset the server already received.
+    var uploadSliceSize = 1024 * 1024;
+    var uploadRetries = 5;
+
+    async function uploadMp3File(file) {
+        var url = "upload?name=" + encodeURIComponent(file.name);
+        var offset = 0;
+        var retries = 0;
+
+        while (true) {
+            var end = Math.min(offset + uploadSliceSize, file.size);
+            var final = (end == file.size) ? 1 : 0;
+            try {
+                var response = await $.ajax({
+                    url: url + "&offset=" + offset + "&final=" + final,
+                    type: "PUT",
+                    data: file.slice(offset, end),
+                    processData: false,
+                    contentType: "application/octet-stream",
+                    dataType: "json"
+                });
+                offset = response.offset;
+                if (final) {
+                    return response;
+                }
+            } catch (error) {
+                retries += 1;
+                if (retries > uploadRetries) {
+                    throw error;
+                }
+                await sleep(1000);
+                offset = (await $.getJSON(url)).offset;
+            }
+        }
+    }
+
 
     //---------------------------------------------------
     // buttons
@@ -435,9 +496,6 @@ $(function() {
     $( "input[type='button']" ).button(); //use jquery ui
 
     $('#btn_test_alarm').click(function() {
-        $.post("index.html",
-                {
-                  test_alarm: '1',
-                });
+        saveSettings({test_alarm: '1'});
     });
 });